@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Time foregroundAug per foreground in the fast and reference modes.
+
+Run from the repository root: python -m benchmarks.augment"""
+import argparse
+import time
+
+import numpy as np
+
+from utils.generator import foregroundAug, get_foreground_list, load_foreground
+
+
+def time_mode(foregrounds, mode, repeat):
+    rng = np.random.default_rng(0)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for foreground in foregrounds:
+            foregroundAug(foreground, mode=mode, rng=rng)
+    return (time.perf_counter() - start) / (repeat * len(foregrounds))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=30, help="foregrounds per class")
+    parser.add_argument("--repeat", type=int, default=3, help="passes per mode")
+    args = parser.parse_args(argv)
+
+    foregrounds = [
+        np.asarray(load_foreground(path))
+        for files in get_foreground_list()
+        for path in sorted(files)[: args.count]
+    ]
+
+    reference = time_mode(foregrounds, "reference", args.repeat)
+    fast = time_mode(foregrounds, "fast", args.repeat)
+    print(f"foregrounds: {len(foregrounds)}")
+    print(f"reference:   {reference * 1e3:8.2f} ms/foreground")
+    print(f"fast:        {fast * 1e3:8.2f} ms/foreground")
+    print(f"speedup:     {reference / fast:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Micro and macro benchmarks of the generation hot path.
+
+Run from the repository root:
+
+    python -m benchmarks.suite run --out head.json
+    python -m benchmarks.suite compare base.json head.json --threshold 0.1
+
+Every benchmark uses fixed seeds and a fixed subset of the bundled
+backgrounds and foregrounds, so results of two commits are comparable."""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+from utils.batch import generate_sample, sample_curve
+from utils.bezier import (bezier, get_bezier_curve, get_bezier_curves,
+                          get_random_points)
+from utils.compositor import composite, plan_placement
+from utils.gen_utils import label_path, translate_offset
+from utils.generator import (compose, foregroundAug, get_atlas,
+                             get_foreground_list, getForegroundMask,
+                             load_foreground, save_generate)
+from utils.spatial import limit_occlusion
+
+bg_path = "./bg_images/"
+limits = (-5, 15)
+dims = (1280, 720)
+cluster_sizes = ((1, 5), (5, 10), (15, 20))
+
+# ? Commands timed from a fresh interpreter, and modules that the headless
+# ? ones (everything but the GUI) must not import
+startup_commands = {
+    "import[utils.batch]": ["-c", "import utils.batch"],
+    "import[utils.dataset]": ["-c", "import utils.dataset"],
+    "tcg batch --help": ["tcg.py", "batch", "--help"],
+}
+heavy_modules = ("matplotlib", "PyQt5", "skimage", "scipy")
+
+
+def measure(fn, repeat=5, number=1):
+    """Seconds per call of *fn*: median and min over *repeat* rounds of
+    *number* calls."""
+    fn()  # Warm up caches
+    rounds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        rounds.append((time.perf_counter() - start) / number)
+    return {"median": float(np.median(rounds)), "min": float(np.min(rounds))}
+
+
+def load_assets(fg_count=20, bg_count=3):
+    bg_list = sorted(os.path.join(bg_path, s) for s in os.listdir(bg_path))
+    bg_list = bg_list[:bg_count]
+    background = np.asarray(Image.open(bg_list[0]).convert("RGB"))
+    background_mask = np.asarray(Image.open(label_path(bg_list[0])))
+    foregrounds = [
+        np.asarray(load_foreground(path))
+        for files in get_foreground_list()
+        for path in files[:fg_count]
+    ]
+    return bg_list, background, background_mask, foregrounds
+
+
+def cluster_inputs(foregrounds, size, seed=0):
+    """Augmented foregrounds, classes and curve placement of one cluster
+    of *size* foregrounds."""
+    rng = np.random.default_rng(seed)
+    picks = rng.choice(len(foregrounds), size)
+    cluster = [foregroundAug(foregrounds[i], rng=rng) for i in picks]
+    classes = [int(rng.integers(3, 6)) for _ in picks]
+
+    params = sample_curve(limits, rng)
+    init = np.asarray(params[:-1])[rng.choice(len(params) - 1, size)]
+    offsets = [translate_offset(p, limits, dims) for p in init]
+    return cluster, classes, init, params[-1], offsets
+
+
+def run_python(args):
+    subprocess.run([sys.executable, *args], check=True, stdout=subprocess.DEVNULL)
+
+
+def headless_imports():
+    """Heavy modules loaded by importing the headless entry points, which
+    should be none."""
+    modules = ", ".join(repr(m) for m in heavy_modules)
+    code = (
+        "import sys, utils.batch, utils.dataset, utils.shards, utils.atlas, "
+        "utils.tiled; "
+        f"print(' '.join(m for m in ({modules},) if m in sys.modules))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], check=True, capture_output=True, text=True
+    )
+    return result.stdout.split()
+
+
+def run(quick=False):
+    repeat = 3 if quick else 7
+    results = {}
+
+    # ? Startup
+    for name, args in startup_commands.items():
+        results[name] = measure(lambda: run_python(args), repeat)
+
+    bg_list, background, background_mask, foregrounds = load_assets()
+    label = background_mask
+
+    # ? Curves
+    rng = np.random.default_rng(0)
+    points = get_random_points(1, n=6, scale=10)
+    control = rng.random((4, 2))
+    results["bezier"] = measure(lambda: bezier(control, 100), repeat, 1000)
+    results["get_bezier_curve"] = measure(
+        lambda: get_bezier_curve(points, rad=0.5, edgy=0.5), repeat, 100
+    )
+    batch = np.stack([get_random_points(i + 1, n=6, scale=10) for i in range(1000)])
+    results["get_bezier_curves[1000]"] = measure(
+        lambda: get_bezier_curves(batch, rad=0.5, edgy=0.5), repeat
+    )
+    results["get_random_points"] = measure(
+        lambda: get_random_points(0, n=6, scale=10, rng=rng), repeat, 100
+    )
+
+    # ? Per foreground
+    for mode in ("fast", "reference"):
+        aug_rng = np.random.default_rng(0)
+        results[f"foregroundAug[{mode}]"] = measure(
+            lambda: [foregroundAug(fg, mode=mode, rng=aug_rng) for fg in foregrounds],
+            repeat,
+        )
+        results[f"foregroundAug[{mode}]"]["per"] = len(foregrounds)
+
+    # ? Per cluster
+    for size in (5, 20):
+        cluster, classes, init, center, offsets = cluster_inputs(foregrounds, size)
+        shapes = [fg.shape[:2] for fg in cluster]
+        plan = plan_placement(shapes, init, center, offsets)
+        try:
+            composite(cluster, background, label, classes, plan)
+        except ValueError:
+            continue
+
+        results[f"compose[{size}]"] = measure(
+            lambda: compose(cluster, background, init, center, offsets), repeat, 10
+        )
+        results[f"getForegroundMask[{size}]"] = measure(
+            lambda: getForegroundMask(cluster, label, classes, plan), repeat, 10
+        )
+        results[f"composite[{size}]"] = measure(
+            lambda: composite(cluster, background, label, classes, plan), repeat, 10
+        )
+
+    # ? Occlusion limited placement of a dense cluster
+    rng = np.random.default_rng(0)
+    params = sample_curve(limits, rng)
+    picks = rng.choice(len(foregrounds), 100)
+    dense = [foregroundAug(foregrounds[i], rng=rng) for i in picks]
+    indexes = rng.choice(len(params) - 1, len(dense)).tolist()
+    results["limit_occlusion[100]"] = measure(
+        lambda: limit_occlusion(dense, params, indexes, limits, dims, 0.3), repeat
+    )
+
+    # ? Encoding and writing one sample
+    image, mask, mask_pil = generate_sample(0, 0, bg_list)
+    with tempfile.TemporaryDirectory() as tmp:
+        results["save_generate"] = measure(
+            lambda: save_generate(image, mask, mask_pil, path=tmp, savedate=0),
+            repeat,
+            5,
+        )
+
+    # ? End to end, single process, without saving
+    count = 5 if quick else 20
+    for climit in cluster_sizes:
+        name = f"end_to_end[{climit[0]}-{climit[1]}]"
+        results[name] = measure(
+            lambda: [generate_sample(1, i, bg_list, climit) for i in range(count)],
+            max(1, repeat // 2),
+        )
+        results[name]["per"] = count
+        results[name]["images_per_s"] = count / results[name]["median"]
+
+    return results
+
+
+def metadata():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True
+        ).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "atlas": get_atlas() is not None,
+    }
+
+
+def compare(base, head, threshold):
+    """Print the change of every benchmark in both result files and return
+    the names of those slower than *threshold* (relative change)."""
+    regressions = []
+    print(f"{'benchmark':32} {'base':>10} {'head':>10} {'change':>8}")
+    for name, result in head["results"].items():
+        if name not in base["results"]:
+            continue
+        old, new = base["results"][name]["median"], result["median"]
+        change = new / old - 1
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:32} {old * 1e3:9.3f}ms {new * 1e3:9.3f}ms {change:+7.1%}{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument("--out", default=None, help="JSON file for results")
+    run_parser.add_argument("--quick", action="store_true", help="fewer rounds")
+    compare_parser = commands.add_parser("compare", help="compare two results")
+    compare_parser.add_argument("base")
+    compare_parser.add_argument("head")
+    compare_parser.add_argument(
+        "--threshold", type=float, default=0.1, help="allowed slowdown (0.1 = 10%%)"
+    )
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        output = {"meta": metadata(), "results": run(args.quick)}
+        output["headless_imports"] = headless_imports()
+        for name, result in output["results"].items():
+            print(f"{name:32} {result['median'] * 1e3:10.3f} ms")
+        if args.out:
+            with open(args.out, "w") as f:
+                json.dump(output, f, indent=2)
+        if output["headless_imports"]:
+            loaded = ", ".join(output["headless_imports"])
+            print(f"Headless entry points import {loaded}")
+            return 1
+        return 0
+
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.head) as f:
+        head = json.load(f)
+    regressions = compare(base, head, args.threshold)
+    if regressions:
+        print(f"{len(regressions)} regression(s) above {args.threshold:.0%}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,20 +2,22 @@
 # -*- coding: utf-8 -*-
 import logging
 import os
+import sys
 import traceback
 from collections import Counter
 
 import coloredlogs
-import matplotlib
-import matplotlib.pyplot as plt
 import numpy as np
-from matplotlib.widgets import Button, RangeSlider, Slider
 
 from utils.bezier import get_bezier_curve, get_random_points
+from utils.cache import ImageCache
 from utils.cluster_error import (ClusterNotGeneratedError,
                                  OutOfBoundsClusterError, UndoError)
-from utils.generator import (generate_cluster, save_generate, undo_func,
-                             update_cluster)
+from utils.gen_utils import image_dims
+from utils import generator
+from utils.generator import generate_cluster, undo_func, update_cluster
+from utils.preview import ClusterPreview
+from utils.writer import AsyncWriter
 
 # ? Configure logging
 logging.getLogger("matplotlib").setLevel(logging.WARNING)
@@ -23,22 +25,31 @@ logging.getLogger("PIL").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 coloredlogs.install(level="DEBUG", fmt="%(asctime)s - %(message)s", datefmt="%H:%M:%S")
 
-matplotlib.use("Qt5Agg")
-
 
 class TCG():
 
     # @profile
     def __init__(self):
+        # Imported here, so that the batch and atlas commands start without
+        # matplotlib and Qt
+        import matplotlib.pyplot as plt
+        from matplotlib.transforms import Bbox, TransformedBbox
+        from matplotlib.widgets import Button, RangeSlider, Slider
 
-        self.dim_x = 1280               # * Horizonal pixel dimension
-        self.dim_y = 720                # * Vertical pixel dimension
         self.limits = [-5, 15]          # * Curve View axis limits
+        self.cache_budget = 512 * 2 ** 20   # * Decoded image cache (bytes)
+        self.frame_interval = 16        # * Slider redraw interval (ms)
+        self.preview_level = 1          # * Live preview downscale (2 ** level)
         extent = self.limits * 2
-        aspect_ratio = self.dim_x / self.dim_y
         bg_path = "./bg_images/"
         self.bg_list = [bg_path + s for s in os.listdir(bg_path)]
 
+        # * Pixel dimensions of the current background, from its header
+        self.dim_x, self.dim_y = image_dims(self.bg_list[0])
+        aspect_ratio = self.dim_x / self.dim_y
+        self.image_cache = ImageCache(self.cache_budget)
+        self.writer = AsyncWriter()
+
         axis_color = "#ede5c0"
         slider_color = "#bf616a"
 
@@ -67,36 +78,33 @@ class TCG():
         self.cluster_mask = None        # * Segmentation Mask (RGB)
         self.cluster_pil = None         # * Ground Truth Segmentation Mask
         self.cache = None               # * Reference params
+        self.preview = False            # * Live low resolution preview on/off
+        self.preview_stale = False      # * Generator View shows a preview
+        self.preview_count = 0          # * Previews shown, for redraws
+        self.cluster_preview = ClusterPreview(self.preview_level)
 
-        # ? Random Bezier Control Points
-        self.a = (
-            get_random_points(self.seeder, n=self.points, scale=self.scale) + self.c
-        )
-
-        # ? Bezier Curve coordinates and centre
-        self.x, self.y, self.s = get_bezier_curve(self.a, rad=self.rad, edgy=self.edgy)
-        self.centre = np.array(
-            [
-                (np.max(self.x) + np.min(self.x)) / 2,
-                (np.max(self.y) + np.min(self.y)) / 2,
-            ]
+        # ? Random Bezier Control Points, Curve coordinates and centre
+        self.points_key = None          # * (seed, points) of the unit points
+        self.curve_key = None           # * (radius, edginess) of the unit curve
+        self.set_curve(
+            self.seeder, self.points, self.rad, self.edgy, self.c, self.scale
         )
-        self.a_new = np.append(self.a, [self.centre], axis=0)
 
         self.ax_bez.set_xlim(self.limits)
         self.ax_bez.set_ylim(self.limits)
 
         # ? Curve View Image handler
         self.bezier_handler = self.ax_bez.imshow(
-            plt.imread(self.bg_list[self.bg_index]), extent=extent, interpolation="none"
+            self.image_cache.get("thumbnail", self.bg_list[self.bg_index]),
+            extent=extent,
+            interpolation="none",
         )
 
         self.ax_bez.set_aspect(1 / (aspect_ratio))
-        self.ax_img.set_aspect(1 / (aspect_ratio))
 
         # ? Curve View Plot and Scatter handler
         (self.bezier_curve,) = self.ax_bez.plot(
-            self.x, self.y, linewidth=1, color="w", zorder=1
+            self.x, self.y, linewidth=1, color="w", zorder=1, animated=True
         )
         self.scatter_points = self.ax_bez.scatter(
             self.a_new[:, 0],
@@ -105,14 +113,16 @@ class TCG():
             marker=".",
             alpha=1,
             zorder=2,
+            animated=True,
         )
 
         # ? Generator View Image handler
         self.cluster_handler = self.ax_img.imshow(
-            np.flipud(np.array(plt.imread(self.bg_list[0]))),
+            np.flipud(self.image_cache.get("background", self.bg_list[0])),
             origin="lower",
             interpolation="none",
         )
+        self.ax_img.set_aspect("equal")
 
         # ? State Indicator Text handler
         self.text_handler = plt.figtext(
@@ -149,6 +159,7 @@ class TCG():
         )
 
         undo_asset = plt.imread("./assets/undo.png")
+        self.image_cache.prefetch(self.bg_list[1 % len(self.bg_list)])
 
         # ? Sliders
 
@@ -259,15 +270,63 @@ class TCG():
             undo_button_ax, "", image=undo_asset, color="#aee3f2", hovercolor="#85cade"
         )
 
-        # ? Slider event triggers
-        self.rad_slider.on_changed(self.curveplot)
-        self.edgy_slider.on_changed(self.curveplot)
-        self.c0_slider.on_changed(self.curveplot)
-        self.c1_slider.on_changed(self.curveplot)
-        self.scale_slider.on_changed(self.curveplot)
-        self.points_slider.on_changed(self.curveplot)
-        self.seeder_slider.on_changed(self.curveplot)
-        self.cluster_limit_slider.on_changed(self.curveplot)
+        preview_button_ax = self.fig.add_axes([0.85, 0.58, 0.1, 0.05])
+        self.preview_button = Button(
+            preview_button_ax, "Preview: Off", color="#aee3f2", hovercolor="#85cade"
+        )
+
+        # ? Blitting: sliders, curve, scatter and previews are redrawn over
+        # ? backgrounds saved at each full draw, when their state changes
+        self.sliders = [
+            self.rad_slider,
+            self.edgy_slider,
+            self.c0_slider,
+            self.c1_slider,
+            self.scale_slider,
+            self.points_slider,
+            self.seeder_slider,
+            self.cluster_limit_slider,
+        ]
+        self.blit_regions = [
+            (
+                self.ax_bez.bbox,
+                [self.bezier_curve, self.scatter_points],
+                lambda: (self.points_key, self.curve_key, tuple(self.c), self.scale),
+            ),
+            (
+                self.ax_img.bbox,
+                [self.cluster_handler, *self.ax_img.spines.values()],
+                lambda: self.preview_count,
+            ),
+        ]
+        for slider in self.sliders:
+            slider.drawon = False
+            slider.ax.set_animated(True)
+            row = slider.ax.get_position()
+            row = Bbox([[0, row.y0 - 0.01], [0.845, row.y1 + 0.01]])
+            self.blit_regions.append(
+                (
+                    TransformedBbox(row, self.fig.transFigure),
+                    [slider.ax],
+                    lambda slider=slider: tuple(np.ravel(slider.val)),
+                )
+            )
+        self.blit_backgrounds = None
+        self.blit_states = None
+        self.fig.canvas.mpl_connect("draw_event", self.on_draw)
+
+        # ? Slider event triggers, coalesced to one curve update per frame
+        self.curve_pending = False
+        self.curve_timer = self.fig.canvas.new_timer(interval=self.frame_interval)
+        self.curve_timer.single_shot = True
+        self.curve_timer.add_callback(self.flush_curveplot)
+        for slider in self.sliders:
+            slider.on_changed(self.schedule_curveplot)
+
+        # ? Queued saves, reported by polling once they are written
+        self.saves = []
+        self.save_timer = self.fig.canvas.new_timer(interval=100)
+        self.save_timer.add_callback(self.check_saves)
 
         # ? Button event triggers
         self.save_button.on_clicked(self.save)
@@ -284,29 +343,30 @@ class TCG():
         self.update_button.on_clicked(self.update)
         self.undo_button.on_clicked(self.curveplot)
         self.undo_button.on_clicked(self.undo)
+        self.preview_button.on_clicked(self.toggle_preview)
 
         plt.show()
-
-    # @profile
-    def curveplot(self, _):
-
-        self.cluster_limit = (
-            int(self.cluster_limit_slider.val[0]),
-            int(self.cluster_limit_slider.val[1]),
-        )
-        self.c = [self.c0_slider.val, self.c1_slider.val]
-        self.scale = self.scale_slider.val
-        self.a = (
-            get_random_points(
-                int(self.seeder_slider.val),
-                n=int(self.points_slider.val),
-                scale=self.scale,
-            )
-            + self.c
-        )
-        self.x, self.y, _ = get_bezier_curve(
-            self.a, rad=self.rad_slider.val, edgy=self.edgy_slider.val
-        )
+        self.writer.close()
+
+    def set_curve(self, seeder, points, rad, edgy, c, scale):
+        """Recompute the curve, going back only as far as needed: a new
+        *seeder* or *points* resamples the control points, a new *rad* or
+        *edgy* rebuilds the curve through them, and *c* and *scale* only
+        move the cached unit curve (the curve through scaled and translated
+        points is the scaled and translated curve)."""
+        if self.points_key != (seeder, points):
+            self.points_key = (seeder, points)
+            self.unit_points = get_random_points(seeder, n=points, scale=1)
+            self.curve_key = None
+        if self.curve_key != (rad, edgy):
+            self.curve_key = (rad, edgy)
+            x, y, _ = get_bezier_curve(self.unit_points, rad=rad, edgy=edgy)
+            self.unit_curve = np.stack([x, y], axis=1)
+
+        self.c = c
+        self.scale = scale
+        self.a = self.unit_points * scale + c
+        self.x, self.y = (self.unit_curve * scale + c).T
         self.centre = np.array(
             [
                 (np.max(self.x) + np.min(self.x)) / 2,
@@ -315,8 +375,124 @@ class TCG():
         )
         self.a_new = np.append(self.a, [self.centre], axis=0)
 
+    def update_curve(self):
+        self.cluster_limit = (
+            int(self.cluster_limit_slider.val[0]),
+            int(self.cluster_limit_slider.val[1]),
+        )
+        self.set_curve(
+            int(self.seeder_slider.val),
+            int(self.points_slider.val),
+            self.rad_slider.val,
+            self.edgy_slider.val,
+            [self.c0_slider.val, self.c1_slider.val],
+            self.scale_slider.val,
+        )
         self.bezier_curve.set_data(self.x, self.y)
         self.scatter_points.set_offsets(self.a_new)
+
+    def on_draw(self, _):
+        canvas = self.fig.canvas
+        self.blit_backgrounds = []
+        self.blit_states = []
+        for bbox, artists, state in self.blit_regions:
+            self.blit_backgrounds.append(canvas.copy_from_bbox(bbox))
+            self.blit_states.append(state())
+            for artist in artists:
+                if artist.get_animated():
+                    self.fig.draw_artist(artist)
+
+    def blit(self):
+        """Redraw the regions whose state changed since the last full draw or
+        blit over their saved backgrounds, instead of drawing the whole
+        figure."""
+        if self.blit_backgrounds is None:
+            self.fig.canvas.draw_idle()
+            return
+        canvas = self.fig.canvas
+        for i, (bbox, artists, state) in enumerate(self.blit_regions):
+            state = state()
+            if state == self.blit_states[i]:
+                continue
+            self.blit_states[i] = state
+            canvas.restore_region(self.blit_backgrounds[i])
+            for artist in artists:
+                self.fig.draw_artist(artist)
+            canvas.blit(bbox)
+        canvas.flush_events()
+
+    def schedule_curveplot(self, _):
+        """Slider callback. Events arriving within a frame are coalesced and
+        only the latest slider values are drawn."""
+        if not self.curve_pending:
+            self.curve_pending = True
+            self.curve_timer.start()
+
+    def flush_curveplot(self):
+        if self.curve_pending:
+            self.curve_pending = False
+            self.update_curve()
+            if self.preview:
+                self.preview_cluster()
+            self.blit()
+
+    def preview_cluster(self):
+        """Show the current cluster along the current curve, composited at
+        low resolution, in the Generator View. The cluster itself is only
+        updated at full resolution by Update or Save."""
+        if self.cluster_image is None or self.cache is None:
+            return
+        try:
+            image = self.render_preview()
+        except ValueError:
+            # Keep the last preview until the cluster is back in bounds
+            return
+        self.cluster_handler.set_data(np.flipud(image))
+        self.preview_stale = True
+        self.preview_count += 1
+
+    def render_preview(self):
+        """Low resolution image of the current cluster along the current
+        curve. Raises ValueError if it is out of bounds there."""
+        if self.cluster_preview.cache is not self.cache:
+            path = self.bg_list[self.bg_index]
+            thumbnail = None
+            bg_image = self.image_cache.get("background", path)
+            if np.may_share_memory(self.cache[0], bg_image):
+                thumbnail = self.image_cache.get("thumbnail", path)
+            self.cluster_preview.set_cluster(self.cache, thumbnail)
+
+        params = list(zip(self.x, self.y))
+        params.append(tuple(self.centre))
+        image, _ = self.cluster_preview.render(
+            params,
+            self.limits,
+            self.cache[0].shape[1::-1],
+            # Read at call time, like update_cluster does
+            generator.cluster_edge_policy,
+            generator.max_occlusion_ratio,
+            generator.label_alpha_threshold,
+        )
+        return image
+
+    def toggle_preview(self, _):
+        self.preview = not self.preview
+        self.preview_button.label.set_text(
+            "Preview: On" if self.preview else "Preview: Off"
+        )
+        if self.preview:
+            self.preview_cluster()
+        elif self.preview_stale:
+            # Back to the last full resolution cluster
+            self.cluster_handler.set_data(np.flipud(self.cluster_image))
+            self.preview_stale = False
+        self.fig.canvas.draw_idle()
+
+    # @profile
+    def curveplot(self, _):
+        self.curve_timer.stop()
+        self.curve_pending = False
+        self.update_curve()
         self.fig.canvas.draw_idle()
 
     # @profile
@@ -326,7 +502,22 @@ class TCG():
             if self.cluster_image is None:
                 raise ClusterNotGeneratedError
 
-            save_generate(self.cluster_image, self.cluster_mask, self.cluster_pil)
+            if self.preview_stale:
+                # Render the previewed curve at full resolution first. If it
+                # is out of bounds, the last cluster is kept and not saved
+                try:
+                    self.render_preview()
+                except ValueError:
+                    raise OutOfBoundsClusterError
+                self.update(None)
+                if self.preview_stale:
+                    return
+
+            future = self.writer.save(
+                self.cluster_image, self.cluster_mask, self.cluster_pil
+            )
+            self.saves.append(future)
+            self.save_timer.start()
             self.cluster_image = None
             self.cluster_mask = None
             self.cluster_pil = None
@@ -337,18 +528,43 @@ class TCG():
             self.text_handler.set_text("Generate new")
             self.text_handler.set_position((0.87, 0.70))
             self.text_handler.set_backgroundcolor("#ede5c0")
+        except OutOfBoundsClusterError:
+            logger.warning("Out of Bounds. Retry")
+            self.text_handler.set_text("Out of Bounds")
+            self.text_handler.set_position((0.87, 0.70))
+            self.text_handler.set_backgroundcolor("#ede5c0")
         except Exception:
             logger.error(traceback.print_exc())
             self.text_handler.set_text("Error. See logs")
             self.text_handler.set_position((0.87, 0.70))
             self.text_handler.set_backgroundcolor("#bf616a")
+        else:
+            self.text_handler.set_text("Saving")
+            self.text_handler.set_position((0.88, 0.70))
+            self.text_handler.set_backgroundcolor("#ede5c0")
+
+    def check_saves(self):
+        """Timer callback. Report the queued saves that finished, on the GUI
+        thread, and count only those that succeeded."""
+        done = [future for future in self.saves if future.done()]
+        if not done:
+            return
+        self.saves = [future for future in self.saves if future not in done]
+        if not self.saves:
+            self.save_timer.stop()
+        failed = sum(future.exception() is not None for future in done)
+        self.count += len(done) - failed
+        self.count_handler.set_text(f"Generated images: {self.count}")
+        if failed:
+            self.text_handler.set_text("Save failed")
+            self.text_handler.set_position((0.87, 0.70))
+            self.text_handler.set_backgroundcolor("#bf616a")
         else:
             logger.debug("Saved successfully.")
             self.text_handler.set_text("Saved")
             self.text_handler.set_position((0.89, 0.70))
             self.text_handler.set_backgroundcolor("#a3be8c")
-            self.count += 1
-            self.count_handler.set_text(f"Generated images: {self.count}")
+        self.fig.canvas.draw_idle()
 
     # @profile
     def reset(self, _):
@@ -362,15 +578,23 @@ class TCG():
             self.seeder_slider.reset()
             self.cluster_limit_slider.set_val((3, 7))
             self.bg_index = 0
+            self.set_background_dims()
 
             self.cluster_image = None
             self.cluster_mask = None
             self.cluster_pil = None
 
             self.cluster_handler.set_data(
-                np.flipud(np.array(plt.imread(self.bg_list[0])))
+                np.flipud(self.image_cache.get("background", self.bg_list[0]))
+            )
+            self.cluster_handler.set_extent(
+                (-0.5, self.dim_x - 0.5, -0.5, self.dim_y - 0.5)
             )
-            self.bezier_handler.set_data(plt.imread(self.bg_list[self.bg_index]))
+            self.preview_stale = False
+            self.bezier_handler.set_data(
+                self.image_cache.get("thumbnail", self.bg_list[self.bg_index])
+            )
+            self.image_cache.prefetch(self.bg_list[1 % len(self.bg_list)])
 
         except Exception:
             logger.error(traceback.print_exc())
@@ -385,11 +609,26 @@ class TCG():
             for ind, cname in enumerate(self.class_dict):
                 self.class_handlers[ind].set_text(cname + "0".rjust(3))
 
+    def set_background_dims(self):
+        """Map the Curve View onto the current background, which may not
+        have the size of the previous one. The Generator View is in pixels,
+        so with an equal aspect its shape follows the extent of the image
+        it shows."""
+        self.dim_x, self.dim_y = image_dims(self.bg_list[self.bg_index])
+        self.ax_bez.set_aspect(self.dim_y / self.dim_x)
+        self.ax_img.set_aspect("equal")
+
     # @profile
     def background(self, _):
         try:
             self.bg_index = (self.bg_index + 1) % len(self.bg_list)
-            self.bezier_handler.set_data(plt.imread((self.bg_list[self.bg_index])))
+            self.set_background_dims()
+            self.bezier_handler.set_data(
+                self.image_cache.get("thumbnail", self.bg_list[self.bg_index])
+            )
+            self.image_cache.prefetch(
+                self.bg_list[(self.bg_index + 1) % len(self.bg_list)]
+            )
         except Exception:
             logger.error(traceback.print_exc())
             self.text_handler.set_text("Error. See logs")
@@ -404,14 +643,8 @@ class TCG():
     # @profile
     def generate(self, _):
         try:
-            bg_image = np.array(plt.imread(self.bg_list[self.bg_index]))
-            bg_mask = np.array(
-                plt.imread(
-                    self.bg_list[self.bg_index]
-                    .replace("images", "labels")
-                    .replace("jpeg", "png")
-                )
-            )
+            bg_image = self.image_cache.get("background", self.bg_list[self.bg_index])
+            bg_mask = self.image_cache.get("label", self.bg_list[self.bg_index])
             params = list(zip(self.x, self.y))
             params.append(tuple(self.centre))
             (
@@ -432,6 +665,10 @@ class TCG():
                 raise OutOfBoundsClusterError
 
             self.cluster_handler.set_data(np.flipud(self.cluster_image))
+            self.cluster_handler.set_extent(
+                (-0.5, self.dim_x - 0.5, -0.5, self.dim_y - 0.5)
+            )
+            self.preview_stale = False
 
         except OutOfBoundsClusterError:
             logger.warning("Out of Bounds. Retry")
@@ -478,7 +715,7 @@ class TCG():
                 params,
                 self.cluster_limit,
                 self.limits,
-                (self.dim_x, self.dim_y),
+                self.cache[0].shape[1::-1],
                 new_cluster=False,
             )
 
@@ -486,6 +723,7 @@ class TCG():
                 raise OutOfBoundsClusterError
 
             self.cluster_handler.set_data(np.flipud(self.cluster_image))
+            self.preview_stale = False
 
         except ClusterNotGeneratedError:
             logger.warning("Generate cluster before adding a new one.")
@@ -526,13 +764,7 @@ class TCG():
             if self.cluster_image is None:
                 raise ClusterNotGeneratedError
 
-            bg_mask = np.array(
-                plt.imread(
-                    self.bg_list[self.bg_index]
-                    .replace("images", "labels")
-                    .replace("jpeg", "png")
-                )
-            )
+            bg_mask = self.image_cache.get("label", self.bg_list[self.bg_index])
 
             if np.array_equal(bg_mask, self.cache[1]):
                 new_cluster = True
@@ -547,13 +779,18 @@ class TCG():
                 self.cluster_pil,
                 self.cache,
             ) = update_cluster(
-                *self.cache, params, self.limits, (self.dim_x, self.dim_y), new_cluster
+                *self.cache,
+                params,
+                self.limits,
+                self.cache[0].shape[1::-1],
+                new_cluster,
             )
 
             if np.array_equal(self.cluster_image, self.cache[0]):
                 raise OutOfBoundsClusterError
 
             self.cluster_handler.set_data(np.flipud(self.cluster_image))
+            self.preview_stale = False
 
         except ClusterNotGeneratedError:
             logger.warning("Generate cluster before updating.")
@@ -591,12 +828,13 @@ class TCG():
                 self.cluster_mask,
                 self.cluster_pil,
                 self.cache,
-            ) = undo_func()
+            ) = undo_func(self.cluster_image, self.cluster_mask)
 
             if self.cache is None:
                 raise UndoError
 
             self.cluster_handler.set_data(np.flipud(self.cluster_image))
+            self.preview_stale = False
 
         except UndoError:
             logger.warning("Cannot undo as there is no previous state.")
@@ -624,4 +862,24 @@ class TCG():
 
 
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["batch"]:
+        from utils.batch import main
+
+        sys.exit(main(sys.argv[2:]))
+    if sys.argv[1:2] == ["atlas"]:
+        from utils.atlas import main
+
+        sys.exit(main(sys.argv[2:]))
+    if sys.argv[1:2] == ["manifest"]:
+        from utils.manifest import main
+
+        sys.exit(main(sys.argv[2:]))
+    if sys.argv[1:2] == ["tiled"]:
+        from utils.tiled import main
+
+        sys.exit(main(sys.argv[2:]))
+
+    import matplotlib
+
+    matplotlib.use("Qt5Agg")
     TCG()
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+import glob
+import io
+import os
+
+import numpy as np
+from PIL import Image
+
+from utils.shards import ShardWriter, read_shard
+
+
+def encode_png(array):
+    buffer = io.BytesIO()
+    Image.fromarray(array).save(buffer, format="png")
+    return buffer.getvalue()
+
+
+def sample(i):
+    rng = np.random.default_rng(i)
+    image = rng.integers(0, 256, (16 + i, 24, 3), dtype=np.uint8)
+    label = rng.integers(0, 6, (16 + i, 24), dtype=np.uint8)
+    return image, label, {"png": encode_png(image), "label.png": encode_png(label)}
+
+
+def read_all(path):
+    samples = {}
+    for shard in sorted(glob.glob(os.path.join(path, "shard-*.tar"))):
+        samples.update(read_shard(shard))
+    return samples
+
+
+def test_write_read_round_trip(tmp_path):
+    # Small shards, a name over 100 characters (longer tar header) and a
+    # resumed writer
+    keys = [f"7_{i:08d}" for i in range(5)] + ["x" * 120]
+    with ShardWriter(str(tmp_path), max_bytes=8192) as writer:
+        for i, key in enumerate(keys[:3]):
+            writer.write(key, sample(i)[2])
+    with ShardWriter(str(tmp_path), max_bytes=8192) as writer:
+        assert writer.keys == set(keys[:3])
+        for i, key in enumerate(keys[3:], 3):
+            writer.write(key, sample(i)[2])
+
+    samples = read_all(str(tmp_path))
+    assert sorted(samples) == sorted(keys)
+    for i, key in enumerate(keys):
+        image, label, encoded = sample(i)
+        assert samples[key] == encoded
+        decoded = Image.open(io.BytesIO(samples[key]["png"]))
+        assert np.array_equal(np.asarray(decoded), image)
+        decoded = Image.open(io.BytesIO(samples[key]["label.png"]))
+        assert np.array_equal(np.asarray(decoded), label)
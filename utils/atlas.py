@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import argparse
+import json
+import logging
+import os
+
+import numpy as np
+from PIL import Image
+
+from .gen_utils import edgecrop
+
+logger = logging.getLogger(__name__)
+
+atlas_path = os.getcwd() + "/foregrounds.atlas"
+
+
+class ForegroundAtlas:
+    """Read-only store of decoded and edge-cropped foregrounds.
+
+    All foregrounds are packed back to back in a single uint8 file which is
+    memory-mapped on first access, so lookups are zero-copy slices and every
+    process reading the atlas shares the same page cache. *index.json* maps
+    the path of each foreground (relative to the foreground folder) to its
+    offset and shape in the data file."""
+
+    def __init__(self, path=atlas_path):
+        self.path = path
+        with open(os.path.join(path, "index.json")) as f:
+            self.index = json.load(f)["foregrounds"]
+        self._data = None
+
+    @property
+    def data(self):
+        # Opened lazily so that forked workers each map the file themselves
+        if self._data is None:
+            self._data = np.memmap(
+                os.path.join(self.path, "data.bin"), dtype=np.uint8, mode="r"
+            )
+        return self._data
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, key):
+        offset, shape = self.index[key]
+        size = int(np.prod(shape))
+        return self.data[offset : offset + size].reshape(shape)
+
+
+def build_atlas(fg_path=os.getcwd() + "/foregrounds", path=atlas_path):
+    """Decode and edge-crop every foreground in the class folders of
+    *fg_path* and pack them into an atlas at *path*."""
+    os.makedirs(path, exist_ok=True)
+    index = {}
+    offset = 0
+
+    tmp_data = os.path.join(path, "data.bin.tmp")
+    with open(tmp_data, "wb") as f:
+        for sub_folder in sorted(os.listdir(fg_path)):
+            folder = os.path.join(fg_path, sub_folder)
+            for file in sorted(os.listdir(folder)):
+                image = edgecrop(np.asarray(Image.open(os.path.join(folder, file))))
+                image = np.ascontiguousarray(image, dtype=np.uint8)
+                f.write(image.tobytes())
+                index[os.path.join(sub_folder, file)] = (offset, image.shape)
+                offset += image.nbytes
+
+    tmp_index = os.path.join(path, "index.json.tmp")
+    with open(tmp_index, "w") as f:
+        json.dump({"foregrounds": index}, f)
+
+    # Swap both files in only once they are complete
+    os.replace(tmp_data, os.path.join(path, "data.bin"))
+    os.replace(tmp_index, os.path.join(path, "index.json"))
+
+    logger.info(f"Packed {len(index)} foregrounds ({offset / 2 ** 20:.1f} MB).")
+    return ForegroundAtlas(path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="tcg atlas", description="Build the memory-mapped foreground atlas."
+    )
+    parser.add_argument("--fg-path", default="./foregrounds", help="foregrounds")
+    parser.add_argument("--out", default=atlas_path, help="atlas directory")
+    args = parser.parse_args(argv)
+
+    build_atlas(os.path.abspath(args.fg_path), args.out)
+    return 0
@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+import argparse
+import concurrent.futures
+import logging
+import os
+import time
+
+import numpy as np
+
+from .bezier import get_bezier_curves, sample_random_points
+from .compositor import BufferPool, edge_policies
+from .gen_utils import image_dims, imread, label_path, sample_rng
+from . import generator
+from .generator import encode_sample, generate_cluster, get_manifest
+from .metrics import metrics
+from .shards import ShardWriter
+from .writer import AsyncWriter
+
+logger = logging.getLogger(__name__)
+
+# ? Slider ranges of the TCG window, used to sample curve parameters
+curve_ranges = {
+    "rad": (0.0, 1.0),
+    "edgy": (0.0, 5.0),
+    "scale": (1.0, 20.0),
+    "points": (3, 10),
+}
+
+_worker_config = {}
+
+
+def sample_curve(limits, rng, ranges=curve_ranges):
+    """Sample a closed Bezier curve the way TCG.curveplot builds one from
+    its sliders, and return it as the *params* list expected by
+    generate_cluster (curve points followed by the curve centre).
+    The curve is translated so that it stays inside the Curve View.
+    *rng* is the np.random.Generator to draw from."""
+    rad = rng.uniform(*ranges["rad"])
+    edgy = rng.uniform(*ranges["edgy"])
+    scale = rng.uniform(*ranges["scale"])
+    points = rng.integers(ranges["points"][0], ranges["points"][1], endpoint=True)
+    c = rng.uniform(limits[0], max(limits[0], limits[1] - scale), size=2)
+
+    a = sample_random_points(rng, n=points, scale=scale) + c
+    x, y = get_bezier_curves(a[None], rad=rad, edgy=edgy)[0].T
+    centre = ((np.max(x) + np.min(x)) / 2, (np.max(y) + np.min(y)) / 2)
+
+    params = list(zip(x, y))
+    params.append(centre)
+    return params
+
+
+def generate_sample(
+    seed,
+    index,
+    bg_list,
+    climit=(5, 10),
+    limits=(-5, 15),
+    dims=None,
+    retries=10,
+    edge_policy=None,
+    max_occlusion=None,
+    buffers=None,
+):
+    """Generate sample *index* of the dataset seeded by *seed*. All its
+    randomness comes from sample_rng(seed, index), so the same sample is
+    regenerated bit-identically in any process and in any order.
+    The curve is mapped onto the (width, height) *dims* of the background
+    unless given. With a BufferPool *buffers*, the image is composited
+    into its buffers, which the returned mask shares.
+    Returns (image, mask, mask_pil), or Nones if every curve tried was out
+    of bounds."""
+    rng = sample_rng(seed, index)
+
+    bg_path = bg_list[index % len(bg_list)]
+    if dims is None:
+        dims = image_dims(bg_path)
+    with metrics.stage("background"):
+        bg_image = np.array(imread(bg_path))
+        bg_mask = np.array(imread(label_path(bg_path)))
+    # Buffers the size of the background, whatever *dims* the curve maps onto
+    out = None if buffers is None else buffers.get(bg_image.shape[:2])
+
+    for attempt in range(retries + 1):
+        with metrics.stage("curve"):
+            params = sample_curve(limits, rng)
+        final_background, mask_new, mask_new_pil, _ = generate_cluster(
+            bg_image,
+            bg_mask,
+            params,
+            climit,
+            limits,
+            dims,
+            rng=rng,
+            edge_policy=edge_policy,
+            max_occlusion=max_occlusion,
+            out=out,
+            record=False,
+        )
+        if final_background is not None:
+            metrics.count("images")
+            metrics.count("out_of_bounds_retries", attempt)
+            return final_background, mask_new, mask_new_pil
+    metrics.count("out_of_bounds_retries", retries)
+    metrics.count("images_failed")
+    return None, None, None
+
+
+def sample_key(seed, index):
+    return f"{seed}_{index:08d}"
+
+
+def resolution_buckets(bg_list):
+    """Paths of *bg_list* grouped by their (width, height), largest images
+    first, read from the image headers."""
+    buckets = {}
+    for path in bg_list:
+        buckets.setdefault(image_dims(path), []).append(path)
+    return dict(
+        sorted(buckets.items(), key=lambda item: item[0][0] * item[0][1], reverse=True)
+    )
+
+
+def _init_worker(config):
+    _worker_config.update(config)
+    metrics.enabled = config["metrics"]
+    # run_batch refreshed the manifest, so workers only read it
+    generator.manifest_refresh = False
+    get_manifest.cache_clear()
+    # Encodes and writes loose files while the next sample is generated,
+    # so a buffer is only reused once the saves of its sample are done
+    _worker_config["writer"] = AsyncWriter(workers=1, max_pending=2)
+    _worker_config["writes"] = []
+    _worker_config["buffers"] = BufferPool(depth=3)
+
+
+def _generate_one(index):
+    # Worker metrics since the previous sample go back with the result
+    result = _generate_result(index)
+    return result, metrics.snapshot(reset=True) if metrics.enabled else None
+
+
+def _generate_result(index):
+    config = _worker_config
+    final_background, mask_new, mask_new_pil = generate_sample(
+        config["seed"],
+        index,
+        config["bg_list"],
+        config["climit"],
+        config["limits"],
+        config["dims"],
+        config["retries"],
+        config["edge_policy"],
+        config["max_occlusion"],
+        config["buffers"],
+    )
+    if final_background is None:
+        return None
+
+    # Shards are written by the parent process, loose files by the worker
+    if config["shards"]:
+        return encode_sample(final_background, mask_new, mask_new_pil)
+    future = config["writer"].save(
+        final_background,
+        mask_new,
+        mask_new_pil,
+        path=config["out_dir"],
+        savedate=sample_key(config["seed"], index),
+    )
+    config["writes"].append(future)
+    # The results of a chunk go back together, so its writes are waited for
+    # at its end, and a failed one fails the run
+    if index in config["chunk_ends"]:
+        writes = config["writes"]
+        config["writes"] = []
+        concurrent.futures.wait(writes)
+        for write in writes:
+            if write.exception() is not None:
+                raise write.exception()
+    return True
+
+
+def run_batch(
+    count,
+    workers=None,
+    out_dir=".",
+    seed=None,
+    climit=(5, 10),
+    limits=(-5, 15),
+    dims=None,
+    bg_path="./bg_images/",
+    retries=10,
+    edge_policy=None,
+    max_occlusion=None,
+    shard_size=None,
+    metrics_json=None,
+    metrics_prom=None,
+):
+    """Generate *count* images headlessly with a pool of *workers*
+    processes. Returns the number of images written. *edge_policy* and
+    *max_occlusion* are passed to generate_cluster.
+
+    Backgrounds may have different sizes; samples are handed to workers
+    grouped by background resolution (see resolution_buckets), so that
+    their composite buffers are reused from one sample to the next.
+
+    With *shard_size* (bytes), samples are streamed into tar shards of that
+    size in *out_dir* instead of loose files. Samples already present in
+    the shards are skipped, so an interrupted run can be resumed with the
+    same seed. Loose files are written in the background by the workers,
+    and a failed write is raised here.
+
+    Stage timings and counters of all workers are collected when
+    *metrics_json* or *metrics_prom* is given, and written there as a JSON
+    summary or a Prometheus textfile (refreshed during the run)."""
+    os.makedirs(out_dir, exist_ok=True)
+    if seed is None:
+        seed = int(time.time())
+
+    config = {
+        "bg_list": sorted(os.path.join(bg_path, s) for s in os.listdir(bg_path)),
+        "out_dir": out_dir,
+        "seed": seed,
+        "climit": tuple(climit),
+        "limits": list(limits),
+        "dims": None if dims is None else tuple(dims),
+        "retries": retries,
+        "edge_policy": edge_policy,
+        "max_occlusion": max_occlusion,
+        "shards": shard_size is not None,
+        "metrics": bool(metrics_json or metrics_prom),
+    }
+    metrics.enabled = config["metrics"]
+    workers = workers or os.cpu_count()
+    # ? Refresh the foreground manifest once, before the workers read it
+    get_manifest()
+    chunksize = max(1, min(64, count // (workers * 4)))
+
+    # ? Sample indexes keep their background, only the order changes
+    buckets = resolution_buckets(config["bg_list"])
+    bucket_of = {
+        path: bucket for bucket, paths in enumerate(buckets.values()) for path in paths
+    }
+    n_bg = len(config["bg_list"])
+    indexes = sorted(range(count), key=lambda i: bucket_of[config["bg_list"][i % n_bg]])
+    if len(buckets) > 1:
+        sizes = ", ".join(f"{w}x{h}" for w, h in buckets)
+        logger.info(f"Backgrounds of {len(buckets)} resolutions: {sizes}")
+    writer = None
+    if shard_size is not None:
+        writer = ShardWriter(out_dir, max_bytes=shard_size)
+        indexes = [i for i in indexes if sample_key(seed, i) not in writer.keys]
+        if len(indexes) < count:
+            logger.info(f"Resuming: {count - len(indexes)} images already in shards.")
+    # ? Last sample of every chunk handed to a worker
+    config["chunk_ends"] = set(indexes[chunksize - 1 :: chunksize] + indexes[-1:])
+
+    logger.info(f"Generating {count} images with {workers} workers (seed {seed}).")
+    start = time.perf_counter()
+    done = count - len(indexes)
+    failed = 0
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_worker, initargs=(config,)
+    ) as executor:
+        results = executor.map(_generate_one, indexes, chunksize=chunksize)
+        for index, (result, snapshot) in zip(indexes, results):
+            if snapshot is not None:
+                metrics.merge(snapshot)
+            if result is None:
+                failed += 1
+            else:
+                if writer is not None:
+                    with metrics.stage("write"):
+                        writer.write(sample_key(seed, index), result)
+                    metrics.count("bytes_written", sum(map(len, result.values())))
+                done += 1
+            if (done + failed) % 1000 == 0:
+                rate = (done + failed) / (time.perf_counter() - start)
+                logger.info(f"{done + failed}/{count} images ({rate:.1f} img/s)")
+                if metrics_prom:
+                    metrics.write_prometheus(metrics_prom)
+
+    if writer is not None:
+        writer.close()
+    if metrics_json:
+        metrics.write_json(metrics_json)
+    if metrics_prom:
+        metrics.write_prometheus(metrics_prom)
+
+    elapsed = time.perf_counter() - start
+    if failed:
+        logger.warning(f"{failed} images out of bounds after {retries} retries.")
+    rate = (done - count + len(indexes)) / elapsed
+    logger.info(f"Saved {done} images in {elapsed:.1f}s ({rate:.1f} img/s)")
+    return done
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="tcg batch", description="Generate trash clusters without the GUI."
+    )
+    parser.add_argument("--count", type=int, required=True, help="images to save")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes")
+    parser.add_argument("--out", default=".", help="output directory")
+    parser.add_argument("--seed", type=int, default=None, help="base random seed")
+    parser.add_argument(
+        "--cluster-limit",
+        type=int,
+        nargs=2,
+        default=(5, 10),
+        metavar=("MIN", "MAX"),
+        help="range of foregrounds per cluster",
+    )
+    parser.add_argument("--bg-path", default="./bg_images/", help="backgrounds")
+    parser.add_argument(
+        "--retries", type=int, default=10, help="new curves tried when out of bounds"
+    )
+    parser.add_argument(
+        "--edge-policy",
+        choices=edge_policies,
+        default=None,
+        help="foregrounds crossing the image edge: clip them, drop them or "
+        "reject the cluster (default)",
+    )
+    parser.add_argument(
+        "--max-occlusion",
+        type=float,
+        default=None,
+        metavar="RATIO",
+        help="move or leave out foregrounds that would hide more than this "
+        "fraction of another's label",
+    )
+    parser.add_argument(
+        "--shard-size",
+        type=float,
+        default=None,
+        metavar="MB",
+        help="write tar shards of this size instead of loose files",
+    )
+    parser.add_argument(
+        "--metrics-json", default=None, help="write stage timings to this file"
+    )
+    parser.add_argument(
+        "--metrics-prom",
+        default=None,
+        help="write stage timings as a Prometheus textfile",
+    )
+    args = parser.parse_args(argv)
+
+    done = run_batch(
+        args.count,
+        workers=args.workers,
+        out_dir=args.out,
+        seed=args.seed,
+        climit=args.cluster_limit,
+        bg_path=args.bg_path,
+        retries=args.retries,
+        edge_policy=args.edge_policy,
+        max_occlusion=args.max_occlusion,
+        shard_size=None if args.shard_size is None else int(args.shard_size * 2 ** 20),
+        metrics_json=args.metrics_json,
+        metrics_prom=args.metrics_prom,
+    )
+    return 0 if done == args.count else 1
@@ -1,20 +1,25 @@
 # -*- coding: utf-8 -*-
+import functools
+import math
 import os
 
-import matplotlib.pyplot as plt
 import numpy as np
-from scipy.special import binom
 
-bernstein = lambda n, k, t: binom(n, k) * t ** k * (1.0 - t) ** (n - k)
+bernstein = lambda n, k, t: math.comb(n, k) * t ** k * (1.0 - t) ** (n - k)
 
 
-def bezier(points, num=200):
-    N = len(points)
+@functools.lru_cache(maxsize=None)
+def bernstein_basis(N, num):
+    """(num, N) matrix of the Bernstein polynomials of degree N - 1,
+    evaluated at num points in [0, 1]."""
     t = np.linspace(0, 1, num=num)
-    curve = np.zeros((num, 2))
-    for i in range(N):
-        curve += np.outer(bernstein(N - 1, i, t), points[i])
-    return curve
+    basis = np.stack([bernstein(N - 1, i, t) for i in range(N)], axis=1)
+    basis.setflags(write=False)
+    return basis
+
+
+def bezier(points, num=200):
+    return bernstein_basis(len(points), num) @ points
 
 
 class Segment:
@@ -83,23 +88,72 @@ def get_bezier_curve(a, rad=0.2, edgy=0):
     return x, y, s
 
 
-def get_random_points(seeder, n=5, scale=2, mindst=None, rec=0):
-    if seeder > 0:
-        np.random.seed(seeder)
-    else:
-        pass
+def get_bezier_curves(a, rad=0.2, edgy=0, numpoints=100):
+    """Batched get_bezier_curve: create closed curves through each of the
+    (batch, n, 2) arrays of points *a*, in one matrix product against the
+    cached cubic Bernstein basis. *rad* and *edgy* are scalars or one value
+    per curve. Returns a (batch, n * numpoints, 2) array of curve points."""
+    a = np.asarray(a, dtype=float)
+    batch, n, _ = a.shape
+    rad = np.broadcast_to(np.asarray(rad, dtype=float), (batch,))[:, None]
+    p = np.arctan(np.broadcast_to(np.asarray(edgy, dtype=float), (batch,)))
+    p = (p / np.pi + 0.5)[:, None]
+
+    # ccw_sort each set of points and close it
+    d = a - np.mean(a, axis=1, keepdims=True)
+    order = np.argsort(np.arctan2(d[:, :, 0], d[:, :, 1]), axis=1)
+    a = np.take_along_axis(a, order[:, :, None], axis=1)
+    a = np.concatenate([a, a[:, :1]], axis=1)
+
+    d = np.diff(a, axis=1)
+    ang = np.arctan2(d[:, :, 1], d[:, :, 0])
+    ang = (ang >= 0) * ang + (ang < 0) * (ang + 2 * np.pi)
+    ang1 = ang
+    ang2 = np.roll(ang, 1, axis=1)
+    ang = p * ang1 + (1 - p) * ang2 + (np.abs(ang2 - ang1) > np.pi) * np.pi
+    ang_next = np.roll(ang, -1, axis=1)
+
+    # Control points of every segment, as in Segment
+    r = rad * np.sqrt(np.sum(d ** 2, axis=2))
+    ctrl = np.empty((batch, n, 4, 2))
+    ctrl[:, :, 0] = a[:, :-1]
+    ctrl[:, :, 1, 0] = a[:, :-1, 0] + r * np.cos(ang)
+    ctrl[:, :, 1, 1] = a[:, :-1, 1] + r * np.sin(ang)
+    ctrl[:, :, 2, 0] = a[:, 1:, 0] + r * np.cos(ang_next + np.pi)
+    ctrl[:, :, 2, 1] = a[:, 1:, 1] + r * np.sin(ang_next + np.pi)
+    ctrl[:, :, 3] = a[:, 1:]
+
+    curves = bernstein_basis(4, numpoints) @ ctrl
+    return curves.reshape(batch, n * numpoints, 2)
+
+
+def sample_random_points(rng, n=5, scale=2, mindst=None, tries=200):
     """create n random points in the unit square, which are *mindst*
-    apart, then scale them."""
+    apart, then scale them.
+    All *tries* + 1 candidate sets are drawn from the np.random.Generator
+    *rng* at once and the first valid one is returned (the last one if
+    none is valid)."""
     mindst = mindst or 0.7 / n
-    a = np.random.rand(n, 2)
-    d = np.sqrt(np.sum(np.diff(ccw_sort(a), axis=0), axis=1) ** 2)
-    if np.all(d >= mindst) or rec >= 200:
-        return a * scale
-    else:
-        return get_random_points(seeder, n=n, scale=scale, mindst=mindst, rec=rec + 1)
+    a = rng.random((tries + 1, n, 2))
+    d = a - np.mean(a, axis=1, keepdims=True)
+    order = np.argsort(np.arctan2(d[:, :, 0], d[:, :, 1]), axis=1)
+    d = np.diff(np.take_along_axis(a, order[:, :, None], axis=1), axis=1)
+    d = np.sqrt(np.sum(d, axis=2) ** 2)
+    valid = np.all(d >= mindst, axis=1)
+    return a[np.argmax(valid) if valid.any() else tries] * scale
+
+
+def get_random_points(seeder, n=5, scale=2, mindst=None, rng=None):
+    """sample_random_points with a generator seeded by *seeder* (or fresh
+    entropy if it is 0) unless *rng* is given."""
+    if rng is None:
+        rng = np.random.default_rng(seeder if seeder > 0 else None)
+    return sample_random_points(rng, n=n, scale=scale, mindst=mindst)
 
 
 def bezier_plot(fill=True, rad=0.5, edgy=0.05):
+    import matplotlib.pyplot as plt
+
     c = [0, 1]
     a = get_random_points(seeder=0, n=4, scale=10) + c
     x, y, _ = get_bezier_curve(a, rad=rad, edgy=edgy)
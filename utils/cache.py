@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import concurrent.futures
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+from .gen_utils import imread, label_path
+
+
+class ImageCache:
+    """Bounded LRU cache of decoded backgrounds, labels and preview
+    thumbnails, keyed by background path.
+
+    Entries are evicted least recently used first once their total size
+    exceeds *max_bytes*. Cached arrays are read-only, since they are shared
+    by every caller. Images can be decoded ahead of time on a background
+    thread with prefetch."""
+
+    def __init__(self, max_bytes=512 * 2 ** 20, thumb_width=640):
+        self.max_bytes = max_bytes
+        self.thumb_width = thumb_width
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def _load(self, key):
+        kind, path = key
+        if kind == "background":
+            image = np.array(imread(path))
+        elif kind == "label":
+            image = np.array(imread(label_path(path)))
+        else:
+            image = self.get("background", path)
+            height = image.shape[0] * self.thumb_width // image.shape[1]
+            image = np.asarray(
+                Image.fromarray(image).resize(
+                    (self.thumb_width, height), Image.BILINEAR
+                )
+            )
+        image.setflags(write=False)
+        return image
+
+    def _store(self, key, image):
+        with self._lock:
+            if key in self._entries:
+                return self._entries[key]
+            self._entries[key] = image
+            self.nbytes += image.nbytes
+            while self.nbytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+            return image
+
+    def get(self, kind, path):
+        """Return the decoded *kind* ("background", "label" or "thumbnail")
+        of the background at *path*."""
+        key = (kind, path)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            pending = self._pending.get(key)
+        if pending is not None:
+            return pending.result()
+        return self._store(key, self._load(key))
+
+    def _prefetch(self, key):
+        # Returns the image, which get hands out while the key is pending
+        try:
+            with self._lock:
+                if key in self._entries:
+                    return self._entries[key]
+            return self._store(key, self._load(key))
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+    def prefetch(self, path):
+        """Decode the background at *path*, its label and thumbnail on the
+        background thread."""
+        for kind in ("background", "label", "thumbnail"):
+            key = (kind, path)
+            with self._lock:
+                if key in self._entries or key in self._pending:
+                    continue
+                self._pending[key] = self._executor.submit(self._prefetch, key)
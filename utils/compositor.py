@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+
+import numpy as np
+
+# ? Ways of handling foregrounds that cross the image edge
+edge_policies = ("clip", "drop", "reject")
+
+
+class BufferPool:
+    """Preallocated (image, label) *out* buffers for composite, per image
+    resolution, so that images of a resolution seen before are composited
+    without allocating. Buffers are handed out in turn from *depth* pairs
+    per resolution: a pair comes back after *depth* - 1 other images of its
+    resolution, so results still in use (such as pending saves) must be
+    fewer than that. Only the buffers of the *shapes* resolutions requested
+    last are kept, so that memory stays bounded however many resolutions
+    there are, as long as images come grouped by resolution."""
+
+    def __init__(self, depth=1, shapes=1):
+        self.depth = depth
+        self.shapes = shapes
+        self.buffers = OrderedDict()
+
+    def get(self, shape):
+        """Next (image, label) pair for (height, width) *shape*."""
+        pairs, turn = self.buffers.pop(shape, ([], 0))
+        while len(self.buffers) >= self.shapes:
+            # Dropped pairs still in use are freed once they are done with
+            self.buffers.popitem(last=False)
+        if len(pairs) < self.depth:
+            pairs.append(
+                (np.empty((*shape, 3), dtype=np.uint8), np.empty(shape, np.uint8))
+            )
+            pair = pairs[-1]
+        else:
+            pair = pairs[turn % self.depth]
+        self.buffers[shape] = (pairs, turn + 1)
+        return pair
+
+
+def check_uint8(*images):
+    """Raise TypeError unless every array of *images* is uint8, the dtype of
+    backgrounds, labels and foregrounds throughout the pipeline."""
+    for image in images:
+        if image.dtype != np.uint8:
+            raise TypeError(f"Expected a uint8 image, got {image.dtype}")
+
+
+def plan_placement(shapes, init, center, offset_list):
+    """Top left offsets (measured from the bottom row of the image) of
+    foregrounds with the given (height, width) *shapes*, anchored at their
+    curve points *init* (offsets *offset_list*) depending on the quadrant
+    they lie in around *center*. All foregrounds are planned at once."""
+    shapes = np.asarray(shapes, dtype=int).reshape(-1, 2)
+    init = np.asarray(init, dtype=float).reshape(-1, 2)
+    plan = np.array(offset_list, dtype=int).reshape(-1, 2)
+
+    # Quadrant
+    angle = np.degrees(np.arctan2(init[:, 1] - center[1], init[:, 0] - center[0]))
+    first = (0 <= angle) & (angle <= 90)
+    fourth = (-90 <= angle) & (angle < 0)
+    third = (-180 <= angle) & (angle <= 90) & ~first & ~fourth
+
+    plan[:, 0] -= np.where(first | fourth, shapes[:, 1] // 2, 0)
+    plan[:, 1] -= np.where(fourth | third, shapes[:, 0] // 2, 0)
+    return [tuple(offset) for offset in plan.tolist()]
+
+
+def placement_in_bounds(shapes, plan, dims):
+    """Boolean array of which foregrounds of the given (height, width)
+    *shapes*, placed at the offsets of *plan*, lie inside a (dim_y, dim_x)
+    image."""
+    shapes = np.asarray(shapes, dtype=int).reshape(-1, 2)
+    plan = np.asarray(plan, dtype=int).reshape(-1, 2)
+    dim_y, dim_x = dims
+    top = dim_y - plan[:, 1] - shapes[:, 0]
+    return (
+        (plan[:, 0] >= 0)
+        & (top >= 0)
+        & (plan[:, 1] >= 0)
+        & (plan[:, 0] + shapes[:, 1] <= dim_x)
+    )
+
+
+def place_foregrounds(shapes, plan, dims, edge_policy="reject"):
+    """(roi, source) slices of each foreground of the given (height, width)
+    *shapes* placed at the offsets of *plan* on a (dim_y, dim_x) image: the
+    part of the image it covers and the matching part of the vertically
+    flipped foreground, or None if it is left out.
+
+    Foregrounds crossing the image edge are clipped to it ("clip"), left
+    out ("drop"), or make the whole cluster fail ("reject"). Raises
+    ValueError if the cluster is rejected or no foreground is left."""
+    shapes = np.asarray(shapes, dtype=int).reshape(-1, 2)
+    plan = np.asarray(plan, dtype=int).reshape(-1, 2)
+    inside = placement_in_bounds(shapes, plan, dims)
+    if edge_policy == "reject" and not inside.all():
+        raise ValueError("Foreground is out of bounds")
+
+    dim_y, dim_x = dims
+    placements = []
+    for (img_h, img_w), (off_x, off_y), fits in zip(
+        shapes.tolist(), plan.tolist(), inside
+    ):
+        top = dim_y - off_y - img_h
+        y0, y1 = max(top, 0), min(top + img_h, dim_y)
+        x0, x1 = max(off_x, 0), min(off_x + img_w, dim_x)
+        if (edge_policy == "drop" and not fits) or y0 >= y1 or x0 >= x1:
+            placements.append(None)
+            continue
+        placements.append(
+            (
+                (slice(y0, y1), slice(x0, x1)),
+                (slice(y0 - top, y1 - top), slice(x0 - off_x, x1 - off_x)),
+            )
+        )
+
+    if placements and all(placement is None for placement in placements):
+        raise ValueError("No foreground is in bounds")
+    return placements
+
+
+def composite(
+    foregrounds,
+    background,
+    background_mask,
+    classes_list,
+    plan,
+    alpha_threshold=0,
+    out=None,
+    edge_policy="reject",
+    placements=None,
+):
+    """Paste every foreground onto *background* and its class onto
+    *background_mask* in one pass over each foreground's ROI.
+
+    Both inputs are uint8 and left untouched; the results are written into
+    *out*, an (image, label) pair of buffers of the same shapes, which is
+    allocated when not given. Foregrounds are pasted vertically flipped at
+    the offsets of *plan*, matching compose and getForegroundMask, and
+    those crossing the image edge are handled by *edge_policy* (see
+    place_foregrounds). Raises ValueError before writing anything if the
+    cluster is out of bounds. *placements* already returned by
+    place_foregrounds for this plan are used instead of placing it again."""
+    check_uint8(background, background_mask, *foregrounds)
+    if placements is None:
+        placements = place_foregrounds(
+            [fg.shape[:2] for fg in foregrounds],
+            plan,
+            background.shape[:2],
+            edge_policy,
+        )
+
+    if out is None:
+        out = (np.empty_like(background), np.empty_like(background_mask))
+    image, label = out
+    np.copyto(image, background)
+    np.copyto(label, background_mask)
+
+    for foreground, placement, class_value in zip(
+        foregrounds, placements, classes_list
+    ):
+        if placement is None:
+            continue
+        roi, source = placement
+        paste_foreground(
+            image[roi],
+            label[roi],
+            foreground[::-1][source],
+            class_value,
+            alpha_threshold,
+        )
+
+    return image, label
+
+
+def composite_tiled(
+    foregrounds,
+    background,
+    background_mask,
+    classes_list,
+    plan,
+    out,
+    tile=1024,
+    alpha_threshold=0,
+    edge_policy="reject",
+):
+    """composite for images too large to be held in memory, such as
+    memory-mapped *background*, *background_mask* and (image, label) *out*
+    buffers. They are read and written one *tile* x *tile* block at a time,
+    pasting only the parts of the foregrounds over that block, so that a
+    block of each and the foregrounds are all that is in memory at once.
+    Same results as composite."""
+    check_uint8(*foregrounds)
+    placements = place_foregrounds(
+        [fg.shape[:2] for fg in foregrounds],
+        plan,
+        background.shape[:2],
+        edge_policy,
+    )
+    image, label = out
+
+    # Foregrounds over each block, in paste order
+    blocks = {}
+    for i, placement in enumerate(placements):
+        if placement is None:
+            continue
+        rows, columns = placement[0]
+        for block_y in range(rows.start // tile, (rows.stop - 1) // tile + 1):
+            for block_x in range(columns.start // tile, (columns.stop - 1) // tile + 1):
+                blocks.setdefault((block_y, block_x), []).append(i)
+
+    dim_y, dim_x = background.shape[:2]
+    for top in range(0, dim_y, tile):
+        for left in range(0, dim_x, tile):
+            block = (slice(top, top + tile), slice(left, left + tile))
+            image_block = np.array(background[block])
+            label_block = np.array(background_mask[block])
+
+            for i in blocks.get((top // tile, left // tile), ()):
+                (rows, columns), (source_y, source_x) = placements[i]
+                y0, y1 = max(rows.start, top), min(rows.stop, top + tile)
+                x0, x1 = max(columns.start, left), min(columns.stop, left + tile)
+                dy, dx = source_y.start - rows.start, source_x.start - columns.start
+                source = (slice(y0 + dy, y1 + dy), slice(x0 + dx, x1 + dx))
+                roi = (slice(y0 - top, y1 - top), slice(x0 - left, x1 - left))
+                paste_foreground(
+                    image_block[roi],
+                    label_block[roi],
+                    foregrounds[i][::-1][source],
+                    classes_list[i],
+                    alpha_threshold,
+                )
+
+            image[block] = image_block
+            label[block] = label_block
+
+    return image, label
+
+
+def paste_foreground(image, label, foreground, class_value, alpha_threshold=0):
+    """Alpha blend the uint8 RGBA *foreground* onto the *image* patch of the
+    same size and write *class_value* into the *label* patch where its alpha
+    is above *alpha_threshold*, in place."""
+    alpha = foreground[:, :, 3:4].astype(np.uint16)
+
+    # Integer alpha blend, rounded to nearest
+    blend = foreground[:, :, :3] * alpha
+    blend += image * (255 - alpha)
+    blend += 127
+    blend //= 255
+    image[...] = blend
+
+    np.copyto(label, class_value, where=alpha[:, :, 0] > alpha_threshold)
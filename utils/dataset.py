@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+import itertools
+import multiprocessing
+import os
+import time
+import traceback
+
+import numpy as np
+from PIL import Image
+
+from . import generator
+from .batch import generate_sample
+from .generator import get_manifest
+
+
+def _produce(queue, worker, workers, config):
+    # __iter__ refreshed the manifest, so workers only read it
+    generator.manifest_refresh = False
+    get_manifest.cache_clear()
+    # A failure goes to the consumer, which would otherwise wait for the
+    # end of this worker forever
+    try:
+        _produce_samples(queue, worker, workers, config)
+    except Exception:
+        queue.put(("error", traceback.format_exc()))
+    finally:
+        queue.put(None)
+
+
+def _produce_samples(queue, worker, workers, config):
+    stop = config["length"]
+    for index in itertools.count(worker, workers):
+        if stop is not None and index >= stop:
+            break
+        final_background, mask_new, _ = generate_sample(
+            config["seed"],
+            index,
+            config["bg_list"],
+            config["climit"],
+            config["limits"],
+            config["dims"],
+            config["retries"],
+        )
+        if final_background is None:
+            continue
+
+        if config["size"] is not None:
+            final_background = final_background.resize(config["size"], Image.BILINEAR)
+            mask_new = Image.fromarray(mask_new).resize(config["size"], Image.NEAREST)
+        queue.put((index, np.asarray(final_background), np.asarray(mask_new)))
+
+
+class SyntheticDataset:
+    """Iterable of (images, masks) batches generated on the fly, for
+    training straight from the generator without a disk round trip.
+
+    *workers* background processes generate samples (see
+    batch.generate_sample) into a queue holding at most *prefetch* batches.
+    Iterating yields uint8 arrays of shape (batch_size, height, width, 3)
+    and (batch_size, height, width), resized to *size* = (width, height)
+    if given; otherwise each batch holds images of one resolution, as
+    backgrounds may differ in size. Samples are reproducible from *seed*,
+    but arrive in the order workers finish them. The dataset is endless
+    unless *length* (number of sample indexes) is given; out of bounds
+    samples are skipped. An error in a worker is raised again as a
+    RuntimeError while iterating."""
+
+    def __init__(
+        self,
+        batch_size=16,
+        workers=None,
+        prefetch=4,
+        seed=None,
+        size=None,
+        length=None,
+        climit=(5, 10),
+        limits=(-5, 15),
+        dims=None,
+        bg_path="./bg_images/",
+        retries=10,
+    ):
+        self.batch_size = batch_size
+        self.workers = workers or os.cpu_count()
+        self.prefetch = prefetch
+        self.config = {
+            "seed": int(time.time()) if seed is None else seed,
+            "size": size,
+            "length": length,
+            "climit": tuple(climit),
+            "limits": list(limits),
+            "dims": None if dims is None else tuple(dims),
+            "bg_list": sorted(os.path.join(bg_path, s) for s in os.listdir(bg_path)),
+            "retries": retries,
+        }
+
+    def __iter__(self):
+        # ? Refresh the foreground manifest once, before the workers read it
+        get_manifest()
+        queue = multiprocessing.Queue(maxsize=self.prefetch * self.batch_size)
+        processes = [
+            multiprocessing.Process(
+                target=_produce,
+                args=(queue, worker, self.workers, self.config),
+                daemon=True,
+            )
+            for worker in range(self.workers)
+        ]
+        for process in processes:
+            process.start()
+
+        try:
+            # ? Samples waiting for a full batch, per image resolution
+            pending = {}
+            running = len(processes)
+            while running:
+                item = queue.get()
+                if item is None:
+                    running -= 1
+                    continue
+                if item[0] == "error":
+                    raise RuntimeError(f"Dataset worker failed:\n{item[1]}")
+                _, image, mask = item
+                images, masks = pending.setdefault(image.shape, ([], []))
+                images.append(image)
+                masks.append(mask)
+                if len(images) == self.batch_size:
+                    del pending[image.shape]
+                    yield np.stack(images), np.stack(masks)
+            for images, masks in pending.values():
+                yield np.stack(images), np.stack(masks)
+        finally:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.join()
@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
-import random
+import functools
 
 import numpy as np
+from PIL import Image
 
 
 def edgecrop(img):
@@ -19,6 +20,78 @@ def edgecrop(img):
     return image_data_new
 
 
+def to_uint8(img):
+    # Float images in [0, 1] (resampling kernel outputs) to uint8, truncating
+    if img.dtype == np.uint8:
+        return img
+    return (img * 255).astype(np.uint8)
+
+
+def affine_crop(img, angle, zoom, flip=False):
+    """Rotate *img* by *angle* (radians) and scale it by *zoom* about the
+    origin, like skimage.transform.AffineTransform, then optionally mirror it
+    horizontally. The three are folded into one transform which is resampled
+    bilinearly in uint8, straight into the bounding box of the result."""
+    img = edgecrop(to_uint8(img))
+    h, w = img.shape[:2]
+
+    cos, sin = np.cos(angle) * zoom, np.sin(angle) * zoom
+    forward = np.array([[cos, -sin], [sin, cos]])
+    corners = forward @ np.array([[0, w, 0, w], [0, 0, h, h]])
+    low = corners.min(axis=1)
+    out_w, out_h = np.ceil(corners.max(axis=1) - low).astype(int)
+
+    # Output to source mapping, including the translation into the box
+    inverse = np.linalg.inv(forward)
+    if flip:
+        inverse = inverse @ np.array([[-1, 0], [0, 1]])
+        low = low + (out_w, 0)
+    shift = np.linalg.inv(forward) @ low
+    coeffs = (*inverse[0], shift[0], *inverse[1], shift[1])
+
+    out = Image.fromarray(img).transform(
+        (max(out_w, 1), max(out_h, 1)), Image.AFFINE, coeffs, Image.BILINEAR
+    )
+    return edgecrop(np.asarray(out))
+
+
+def imread(path):
+    """Read an image as a uint8 array, without importing matplotlib (palette
+    and grey + alpha PNGs as RGBA, like plt.imread). Backgrounds, labels
+    and foregrounds stay uint8 from here to encoding; only resampling
+    kernels work in float, and convert back with to_uint8."""
+    with Image.open(path) as image:
+        if image.format == "PNG" and image.mode in ("P", "LA"):
+            image = image.convert("RGBA")
+        return np.asarray(image)
+
+
+@functools.lru_cache(maxsize=None)
+def image_dims(path):
+    """(width, height) of the image at *path*, read from its header without
+    decoding it, and cached: the *dims* its curve points are mapped to."""
+    with Image.open(path) as image:
+        return image.size
+
+
+def affine_crop_min_shapes(shapes, angles, zooms):
+    """Lower bounds of the (height, width) of affine_crop of foregrounds whose
+    edge-cropped (height, width) are *shapes*, for the given *angles* and
+    *zooms*, without looking at their pixels: the extent of the rotated
+    and scaled box edges, less a margin for pixels lost in resampling."""
+    shapes = np.asarray(shapes, dtype=float).reshape(-1, 2)
+    cos, sin = np.abs(np.cos(angles)), np.abs(np.sin(angles))
+    zooms = np.asarray(zooms, dtype=float)
+    height = zooms * (shapes[:, 0] * cos - shapes[:, 1] * sin)
+    width = zooms * (shapes[:, 1] * cos - shapes[:, 0] * sin)
+    bounds = np.floor(np.stack([height, width], axis=1)) - 3
+    return np.maximum(bounds, 1).astype(int)
+
+
+def label_path(bg_path):
+    return bg_path.replace("images", "labels").replace("jpeg", "png")
+
+
 def translate_range(value, fromMin, fromMax, toMin, toMax):
     fromSpan = fromMax - fromMin
     toSpan = toMax - toMin
@@ -32,10 +105,27 @@ def translate_offset(offset, limits, dims):
     return (tr_x, tr_y)
 
 
-def init_index_gen(fg_list, n_chunks):
+def translate_offsets(points, limits, dims):
+    """translate_offset of every row of the (n, 2) *points* at once, as an
+    (n, 2) int array."""
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    scaled = (points - limits[0]) / float(limits[1] - limits[0])
+    return np.trunc(scaled * dims).astype(int)
+
+
+def sample_rng(seed, index):
+    """Independent np.random.Generator for sample *index* of the dataset
+    seeded by *seed*, derived with a SeedSequence so that samples can be
+    generated in any order, on any worker."""
+    return np.random.default_rng(np.random.SeedSequence([seed, index]))
+
+
+def init_index_gen(fg_list, n_chunks, rng=None):
+    if rng is None:
+        rng = np.random.default_rng()
+    # One random element of each of n_chunks near equal consecutive chunks
     quo, rem = divmod(len(fg_list), n_chunks)
-    chunks = (
-        fg_list[i * quo + min(i, rem) : (i + 1) * quo + min(i + 1, rem)]
-        for i in range(n_chunks)
-    )
-    return [random.choice(ck) for ck in chunks]
+    chunks = np.arange(n_chunks)
+    starts = chunks * quo + np.minimum(chunks, rem)
+    lengths = quo + (chunks < rem)
+    return [fg_list[i] for i in (starts + rng.integers(lengths)).tolist()]
@@ -1,57 +1,196 @@
 # -*- coding: utf-8 -*-
+import functools
+import io
 import os
-import random
 import time
 import traceback
-from collections import deque
 
-import matplotlib.colors
-import matplotlib.pyplot as plt
 import numpy as np
-import skimage.transform as transform
-from PIL import Image
-
-from .gen_utils import edgecrop, init_index_gen, translate_offset
+from PIL import Image, ImageColor
+
+from .atlas import ForegroundAtlas, atlas_path
+from .compositor import (composite, place_foregrounds, placement_in_bounds,
+                         plan_placement)
+from .gen_utils import (affine_crop, affine_crop_min_shapes, edgecrop,
+                        init_index_gen, to_uint8, translate_offsets)
+from .history import History
+from .manifest import ForegroundManifest, class_from_name, manifest_path
+from .metrics import count_buckets, metrics
+from .spatial import limit_occlusion
 
 fg_path = os.getcwd() + "/foregrounds"
-foreground_full_list = []
-
-for sub_folder in sorted(os.listdir(fg_path)):
-    path = os.path.join(fg_path, sub_folder)
-    files = os.listdir(path)
-    files_path = [os.path.join(path, file) for file in files]
-    foreground_full_list.append(files_path)
 
 class_weights = (0.5, 0.3, 0.2)
 
+# ? Foregrounds with fewer opaque pixels are not sampled (needs the manifest)
+min_opaque_pixels = 0
+
+# ? Manifest field weighting foregrounds within their class, such as
+# ? "opaque" (opaque pixel count), or None to sample them uniformly
+foreground_weight = None
+
+# ? Refresh the manifest on first use (batch workers only read it)
+manifest_refresh = True
+
+# ? Foreground pixels with alpha above this are written to the label
+label_alpha_threshold = 0
+
+# ? "fast": single uint8 resample, "reference": skimage warp in float64
+# ? (both return uint8 foregrounds)
+aug_mode = "fast"
+
+# ? Foregrounds crossing the image edge: "clip" them to the image, "drop"
+# ? them, or "reject" the whole cluster as out of bounds
+cluster_edge_policy = "reject"
+
+# ? Largest fraction of a foreground's label that foregrounds pasted over it
+# ? may hide (None to paste foregrounds wherever their curve point falls)
+max_occlusion_ratio = None
+
 # ? Beach, Other Background, Glass, Metal, Plastic
-cmp = matplotlib.colors.ListedColormap(
-    [
-        "tan",
-        "cyan",
-        "pink",
-        "forestgreen",
-        "blue",
-    ]  # ? default colors
-)
-
-# cmp = matplotlib.colors.ListedColormap(
-#     [
-#         "#EBCB8B",
-#         "#88C0D0",
-#         "#B48EAD",
-#         "#A3BE8C",
-#         "#BF616A",
-#     ]  # ? Banner colors
-# )
-
-history = deque()
-
-
-def foregroundAug(foreground):
+cmp = [
+    "tan",
+    "cyan",
+    "pink",
+    "forestgreen",
+    "blue",
+]  # ? default colors
+
+# cmp = [
+#     "#EBCB8B",
+#     "#88C0D0",
+#     "#B48EAD",
+#     "#A3BE8C",
+#     "#BF616A",
+# ]  # ? Banner colors
+
+# ? Undo steps, as patches of what each cluster painted over
+history = History(max_bytes=256 * 2 ** 20, compress=False)
+
+
+@functools.lru_cache(maxsize=None)
+def get_manifest():
+    """The foreground manifest, if it has been built, refreshed on first
+    use unless manifest_refresh is off."""
+    if not os.path.exists(manifest_path):
+        return None
+    manifest = ForegroundManifest(
+        manifest_path, fg_path, read_only=not manifest_refresh
+    )
+    if manifest_refresh:
+        manifest.refresh()
+    return manifest
+
+
+@functools.lru_cache(maxsize=None)
+def get_foreground_list():
+    """Paths of the foregrounds in each class folder of fg_path, from the
+    manifest if there is one, else listed on first use, and cached."""
+    manifest = get_manifest()
+    if manifest is not None:
+        return manifest.foreground_lists(min_opaque_pixels)
+
+    foreground_full_list = []
+    for sub_folder in sorted(os.listdir(fg_path)):
+        path = os.path.join(fg_path, sub_folder)
+        files = sorted(os.listdir(path))
+        foreground_full_list.append([os.path.join(path, file) for file in files])
+    return foreground_full_list
+
+
+@functools.lru_cache(maxsize=None)
+def get_foreground_weights():
+    """Sampling probabilities of the foregrounds of get_foreground_list
+    within their class, by foreground_weight, or None if they are sampled
+    uniformly (also without a manifest)."""
+    manifest = get_manifest()
+    if foreground_weight is None or manifest is None:
+        return None
+    return manifest.foreground_weights(foreground_weight, min_opaque_pixels)
+
+
+@functools.lru_cache(maxsize=None)
+def get_foreground_classes():
+    """Class of every foreground in the manifest, keyed by path."""
+    manifest = get_manifest()
+    return {} if manifest is None else manifest.classes()
+
+
+@functools.lru_cache(maxsize=None)
+def get_foreground_sizes():
+    """Edge-cropped (height, width) of every foreground known from the
+    manifest or the atlas without decoding it, keyed by path."""
+    manifest = get_manifest()
+    if manifest is not None:
+        return manifest.sizes()
+    fg_atlas = get_atlas()
+    if fg_atlas is not None:
+        return {
+            os.path.join(fg_path, key): tuple(shape[:2])
+            for key, (_, shape) in fg_atlas.index.items()
+        }
+    return {}
+
+
+@functools.lru_cache(maxsize=None)
+def get_atlas():
+    """The foreground atlas, if it has been built, opened on first use."""
+    return ForegroundAtlas(atlas_path) if os.path.isdir(atlas_path) else None
+
+
+@functools.lru_cache(maxsize=None)
+def get_label_palette():
+    """RGB label colors for class values 0-255: class value v gets color
+    v - 1 of cmp (CSS color names or hex), like a colormap with vmin=1,
+    vmax=len(cmp)."""
+    colors = np.array([ImageColor.getrgb(color)[:3] for color in cmp], np.uint8)
+    return colors[np.clip(np.arange(256) - 1, 0, len(cmp) - 1)]
+
+
+def __getattr__(name):
+    # Module attributes that used to be computed at import time
+    if name == "foreground_full_list":
+        return get_foreground_list()
+    if name == "fg_atlas":
+        return get_atlas()
+    if name == "label_palette":
+        return get_label_palette()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def load_foreground(path):
+    # Pre-decoded slice from the atlas if it has been built, else the PNG
+    fg_atlas = get_atlas()
+    if fg_atlas is not None:
+        key = os.path.relpath(path, fg_path)
+        if key in fg_atlas:
+            return fg_atlas[key]
+    return np.asarray(Image.open(path))
+
+
+def sample_augmentation(rng):
     # Random rotation, zoom, translation
-    angle = np.random.randint(-10, 10) * (np.pi / 180.0)  # Convert to radians
-    zoom = np.random.random() * 0.2 + 0.1  # Zoom in range [0.1,0.3)
+    angle = rng.integers(-10, 10) * (np.pi / 180.0)  # Convert to radians
+    zoom = rng.random() * 0.2 + 0.1  # Zoom in range [0.1,0.3)
+    # Random horizontal flip with 0.5 probability
+    flip = rng.integers(0, 100) >= 50
+    return angle, zoom, flip
+
+
+def foregroundAug(foreground, mode=None, rng=None, params=None):
+    """Randomly rotate, zoom and flip *foreground*, with the parameters
+    drawn from *rng*, or the (angle, zoom, flip) *params* drawn beforehand
+    by sample_augmentation."""
+    if params is None:
+        if rng is None:
+            rng = np.random.default_rng()
+        params = sample_augmentation(rng)
+    angle, zoom, flip = params
+
+    if (mode or aug_mode) == "fast":
+        return affine_crop(foreground, angle, zoom, flip)
+
+    import skimage.transform as transform
 
     t_x, t_y = 0, 0
 
@@ -59,161 +198,361 @@ def foregroundAug(foreground):
         scale=(zoom, zoom), rotation=angle, translation=(t_x, t_y)
     )
     foreground = transform.warp(foreground, tform.inverse)
-    # Random horizontal flip with 0.5 probability
-    if np.random.randint(0, 100) >= 50:
+    if flip:
         foreground = foreground[:, ::-1]
 
-    return edgecrop(foreground)
+    # The warp works in float64; back to uint8 once it is done
+    return to_uint8(edgecrop(foreground))
 
 
 def compose(foregrounds, background, init, center, offset_list):
     background = Image.fromarray(background)
     flipbg = background.transpose(Image.FLIP_TOP_BOTTOM)
 
-    # Offset list
-    offset_new_list = []
-    for i in range(len(foregrounds)):
-        current_foreground = Image.fromarray((foregrounds[i] * 255).astype(np.uint8))
-        im_w, im_h = current_foreground.size
-
-        # Quadrant
-        current_init = init[i]
-        theta = np.arctan2(current_init[1] - center[1], current_init[0] - center[0])
-        angle = np.degrees(theta)
-
-        # Offset
-        offset = offset_list[i]
-
-        if 0 <= angle <= 90:
-            offset_new = offset[0] - (im_w // 2), offset[1]
-        elif -90 <= angle < 0:
-            offset_new = offset[0] - (im_w // 2), offset[1] - (im_h // 2)
-        elif -180 <= angle <= 90:
-            offset_new = offset[0], offset[1] - (im_h // 2)
-        else:
-            offset_new = offset
-
+    offset_new_list = plan_placement(
+        [fg.shape[:2] for fg in foregrounds], init, center, offset_list
+    )
+    for current_foreground, offset_new in zip(foregrounds, offset_new_list):
+        current_foreground = Image.fromarray(current_foreground)
         flipbg.paste(
             current_foreground, offset_new, current_foreground.convert("RGBA")
         )  # RGBA ==> RGB alpha channel
 
-        offset_new_list.append(offset_new)
-
     background = flipbg.transpose(Image.FLIP_TOP_BOTTOM)
 
     return background, offset_new_list
 
 
 def getForegroundMask(
-    foregrounds, background, background_mask, classes_list, modified_offs, new_cluster
+    foregrounds,
+    background_mask,
+    classes_list,
+    modified_offs,
+    alpha_threshold=None,
+    out=None,
+    edge_policy=None,
 ):
+    if alpha_threshold is None:
+        alpha_threshold = label_alpha_threshold
+    if edge_policy is None:
+        edge_policy = cluster_edge_policy
+    placements = place_foregrounds(
+        [fg.shape[:2] for fg in foregrounds],
+        modified_offs,
+        background_mask.shape[:2],
+        edge_policy,
+    )
 
-    background = Image.fromarray(background)
+    # Label buffer, reused when the caller passes one in
+    if out is None:
+        out = np.empty(background_mask.shape[:2], dtype=np.uint8)
+    np.copyto(out, background_mask)
 
-    if new_cluster:
-        mask_new = np.flipud((background_mask * 255).astype(np.uint8))
-    else:
-        mask_new = np.flipud(background_mask)
+    for i, placement in enumerate(placements):
+        if placement is None:
+            continue
+        roi, source = placement
+        alpha = foregrounds[i][::-1, :, 3][source]
 
-    for i in range(len(foregrounds)):
-        foregrounds[i] = foregrounds[i] * 255  # Scaling
+        # Paste the opaque part of the (vertically flipped) foreground
+        np.copyto(out[roi], classes_list[i], where=alpha > alpha_threshold)
 
-        # Get current foreground mask
-        current_foreground = (
-            1 - np.uint8(np.all(foregrounds[i][:, :, :3] == 0, axis=2))
-        ) * classes_list[i]
+    return out
 
-        img_w, img_h = current_foreground.shape
-        offset = modified_offs[i]
 
-        roi = np.copy(
-            mask_new[offset[1] : offset[1] + img_w, offset[0] : offset[0] + img_h]
+def render_cluster(
+    foregrounds,
+    background,
+    background_mask,
+    classes_list,
+    init,
+    center,
+    offsets,
+    edge_policy=None,
+    out=None,
+):
+    if edge_policy is None:
+        edge_policy = cluster_edge_policy
+    with metrics.stage("composite"):
+        shapes = [fg.shape[:2] for fg in foregrounds]
+        plan = plan_placement(shapes, init, center, offsets)
+        placements = place_foregrounds(
+            shapes, plan, background.shape[:2], edge_policy
         )
-
-        roi_mask = np.logical_and(
-            np.logical_or(
-                np.logical_or((roi == 1).astype(bool), (roi == 2).astype(bool)),
-                (roi != classes_list[i]).astype(bool),
-            ),
-            (current_foreground != 0).astype(bool),
+        rois = [placement[0] for placement in placements if placement is not None]
+        if metrics.enabled:
+            inside = placement_in_bounds(shapes, plan, background.shape[:2])
+            metrics.count("foregrounds_off_edge", int(np.count_nonzero(~inside)))
+        image, mask_new = composite(
+            foregrounds,
+            background,
+            background_mask,
+            classes_list,
+            plan,
+            alpha_threshold=label_alpha_threshold,
+            out=out,
+            placements=placements,
         )
+    return Image.fromarray(image), mask_new, Image.fromarray(mask_new), rois
+
+
+def record_history(cache_for_update, rois):
+    background, background_mask, *cluster = cache_for_update
+    history.record(background, background_mask, rois, cluster)
 
-        # Paste current foreground mask over previous mask
-        np.copyto(
-            mask_new[offset[1] : offset[1] + img_w, offset[0] : offset[0] + img_h],
-            current_foreground,
-            where=roi_mask,
+
+def spread_cluster(
+    foregrounds,
+    classes_list,
+    init_indexes,
+    params,
+    limits,
+    dims,
+    background,
+    edge_policy,
+    max_occlusion,
+):
+    """Foregrounds, classes and curve point indexes of the cluster, moved
+    along the curve by limit_occlusion so that none hides more than
+    *max_occlusion* of another's label, leaving out those that cannot be
+    placed. Unless *edge_policy* is "clip", foregrounds are only moved to
+    points inside *background*. Unchanged if *max_occlusion* is None, or
+    if no foreground can be placed (for the edge policy to reject)."""
+    if max_occlusion is None:
+        return foregrounds, classes_list, init_indexes
+
+    with metrics.stage("spread"):
+        indexes, placed = limit_occlusion(
+            foregrounds,
+            params,
+            init_indexes,
+            limits,
+            dims,
+            max_occlusion,
+            bounds=None if edge_policy == "clip" else background.shape[:2],
+            alpha_threshold=label_alpha_threshold,
         )
+    moved = np.count_nonzero(np.not_equal(indexes, init_indexes))
+    metrics.count("foregrounds_moved", int(moved))
+    metrics.count("foregrounds_occluded", int(np.count_nonzero(~placed)))
+    if not placed.any():
+        return foregrounds, classes_list, init_indexes
+    kept = np.flatnonzero(placed).tolist()
+    return (
+        [foregrounds[i] for i in kept],
+        [classes_list[i] for i in kept],
+        [indexes[i] for i in kept],
+    )
+
 
-    return np.flipud(mask_new)
+def plan_fits(
+    foreground_list,
+    aug_params,
+    init_list,
+    center,
+    offsets,
+    background,
+    edge_policy,
+    max_occlusion=None,
+):
+    """Whether a cluster of the foregrounds at *foreground_list*, augmented
+    with *aug_params*, can fit on *background*. Placement is planned with
+    lower bounds of the augmented sizes (edge-cropped sizes from the
+    manifest or atlas; 1 pixel if unknown), and a foreground that does not
+    fit at its lower bound does not fit at its real size either. False
+    only for clusters that would be rejected by *edge_policy*; clipped
+    clusters, and clusters spread out by *max_occlusion*, are always tried."""
+    if edge_policy == "clip" or max_occlusion is not None:
+        return True
+    sizes = get_foreground_sizes()
+    shapes = np.array([sizes.get(path, (1, 1)) for path in foreground_list])
+    if aug_mode == "fast":
+        angles, zooms, _ = zip(*aug_params)
+        shapes = affine_crop_min_shapes(shapes, angles, zooms)
+    else:
+        # The reference warp may clip foregrounds, so only assume a pixel
+        shapes = np.ones_like(shapes)
+    plan = plan_placement(shapes, init_list, center, offsets)
+    inside = placement_in_bounds(shapes, plan, background.shape[:2])
+    return bool(inside.any() if edge_policy == "drop" else inside.all())
 
 
-def generate_cluster(
+def sample_cluster(
     background,
-    background_mask,
     params,
     climit,
     limits,
     dims,
-    foreground_full_list=foreground_full_list,
-    new_cluster=True,
+    foreground_full_list,
+    rng,
+    edge_policy,
+    max_occlusion,
+    check_fits=True,
 ):
-    if background is None:
-        return None, None, None, None
-
+    """Sample, decode and augment the foregrounds of a cluster along the
+    curve *params* and pick their curve points. Returns their (foregrounds,
+    classes, curve point indexes), or None if *check_fits* and the cluster
+    cannot fit on *background* (see plan_fits). Foregrounds are weighted
+    by get_foreground_weights if *foreground_full_list* is
+    get_foreground_list(), and sampled uniformly from any other list."""
     # ? Cluster limits
     cluster_low_limit, cluster_high_limit = climit
 
-    # ? Get foregrounds
-    fg_sampler = np.random.choice(
-        len(class_weights),
-        random.randint(cluster_low_limit, cluster_high_limit),
-        p=class_weights,
-    )
-    foreground_list = [random.choice(foreground_full_list[c]) for c in fg_sampler]
-
-    classes_list = [x.rsplit("_", 1)[0][-1] for x in foreground_list]
-    classes_list = [int(i) for i in classes_list]
-
-    init_indexes = init_index_gen(range(len(params[:-1])), len(foreground_list))
-    init_list = np.asarray(params)[init_indexes]
-    curve_center = params[-1]
+    with metrics.stage("sample"):
+        # ? Get foregrounds
+        fg_sampler = rng.choice(
+            len(class_weights),
+            rng.integers(cluster_low_limit, cluster_high_limit, endpoint=True),
+            p=class_weights,
+        )
+        # Manifest weights follow get_foreground_list, not other lists
+        fg_weights = None
+        if foreground_full_list is get_foreground_list():
+            fg_weights = get_foreground_weights()
+        if fg_weights is None:
+            picks = [rng.integers(len(foreground_full_list[c])) for c in fg_sampler]
+        else:
+            picks = [
+                rng.choice(len(fg_weights[c]), p=fg_weights[c]) for c in fg_sampler
+            ]
+        foreground_list = [
+            foreground_full_list[c][i] for c, i in zip(fg_sampler, picks)
+        ]
+
+        foreground_classes = get_foreground_classes()
+        classes_list = [
+            foreground_classes[x] if x in foreground_classes else class_from_name(x)
+            for x in foreground_list
+        ]
+
+        init_indexes = init_index_gen(
+            range(len(params[:-1])), len(foreground_list), rng=rng
+        )
+        init_list = np.asarray(params)[init_indexes]
+        curve_center = params[-1]
+        aug_params = [sample_augmentation(rng) for _ in foreground_list]
+        offsets = translate_offsets(init_list, limits, dims)
+    metrics.observe("foregrounds_per_image", len(foreground_list), count_buckets)
+
+    # ? A new cluster that cannot fit is rejected before any file is opened
+    if check_fits and not plan_fits(
+        foreground_list,
+        aug_params,
+        init_list,
+        curve_center,
+        offsets,
+        background,
+        edge_policy,
+        max_occlusion,
+    ):
+        metrics.count("out_of_bounds")
+        metrics.count("out_of_bounds_early")
+        return None
 
     foreground_images = []
-    for i in foreground_list:
-        foreground_images.append(np.asarray(Image.open(i)))
-
-    for i in range(len(foreground_images)):
-        foreground_images[i] = foregroundAug(foreground_images[i])
-
-    offsets = [translate_offset(p, limits, dims) for p in init_list]
-
-    cache_for_update = (
-        background[:],
-        background_mask.copy(),
+    with metrics.stage("decode"):
+        for i in foreground_list:
+            foreground_images.append(load_foreground(i))
+
+    with metrics.stage("augment"):
+        for i in range(len(foreground_images)):
+            foreground_images[i] = foregroundAug(
+                foreground_images[i], params=aug_params[i]
+            )
+
+    return spread_cluster(
+        foreground_images,
         classes_list,
-        foreground_images[:],
         init_indexes,
+        params,
+        limits,
+        dims,
+        background,
+        edge_policy,
+        max_occlusion,
     )
 
-    try:
-        final_background, modified_offs = compose(
-            foreground_images, background, init_list, curve_center, offsets
+
+def generate_cluster(
+    background,
+    background_mask,
+    params,
+    climit,
+    limits,
+    dims,
+    foreground_full_list=None,
+    new_cluster=True,
+    rng=None,
+    edge_policy=None,
+    max_occlusion=None,
+    out=None,
+    record=True,
+):
+    if background is None:
+        return None, None, None, None
+    if edge_policy is None:
+        edge_policy = cluster_edge_policy
+    if max_occlusion is None:
+        max_occlusion = max_occlusion_ratio
+    if foreground_full_list is None:
+        foreground_full_list = get_foreground_list()
+
+    # ? Every random choice below is drawn from rng, so a seeded generator
+    # ? reproduces the same cluster
+    if rng is None:
+        rng = np.random.default_rng()
+
+    cluster = sample_cluster(
+        background,
+        params,
+        climit,
+        limits,
+        dims,
+        foreground_full_list,
+        rng,
+        edge_policy,
+        max_occlusion,
+        check_fits=new_cluster,
+    )
+    if cluster is None:
+        if record:
+            history.clear()
+        return None, None, None, None
+    foreground_images, classes_list, init_indexes = cluster
+    curve_center = params[-1]
+    init_list = np.asarray(params)[init_indexes]
+    offsets = translate_offsets(init_list, limits, dims)
+
+    # ? Without *record* (headless generation), there is no cluster to
+    # ? update later and nothing to undo
+    cache_for_update = None
+    if record:
+        cache_for_update = (
+            background[:],
+            background_mask.copy(),
+            classes_list,
+            foreground_images[:],
+            init_indexes,
         )
 
-        mask_new = getForegroundMask(
+    rois = []
+    try:
+        final_background, mask_new, mask_new_pil, rois = render_cluster(
             foreground_images,
             background,
             background_mask,
             classes_list,
-            modified_offs,
-            new_cluster,
+            init_list,
+            curve_center,
+            offsets,
+            edge_policy,
+            out,
         )
-        mask_new_pil = Image.fromarray(mask_new)
 
         return final_background, mask_new, mask_new_pil, cache_for_update
 
     except ValueError:
+        metrics.count("out_of_bounds")
         if new_cluster:
             return None, None, None, None
         return (
@@ -227,11 +566,10 @@ def generate_cluster(
         traceback.print_exc()
 
     finally:
-        if cache_for_update[0] is not None:
-            if len(history) >= 1 and new_cluster:
-                for i in range(len(history)):
-                    history.pop()
-            history.append(cache_for_update)
+        if record:
+            if new_cluster:
+                history.clear()
+            record_history(cache_for_update, rois)
 
 
 def update_cluster(
@@ -244,11 +582,13 @@ def update_cluster(
     limits,
     dims,
     new_cluster,
+    edge_policy=None,
+    max_occlusion=None,
 ):
-
-    curve_center = params[-1]
-    init_list = np.asarray(params)[init_indexes]
-    offsets = [translate_offset(p, limits, dims) for p in init_list]
+    if edge_policy is None:
+        edge_policy = cluster_edge_policy
+    if max_occlusion is None:
+        max_occlusion = max_occlusion_ratio
 
     cache_for_update = (
         background[:],
@@ -258,19 +598,35 @@ def update_cluster(
         init_indexes,
     )
 
+    # ? The cache keeps every foreground, so that those left out along this
+    # ? curve can come back along the next one
+    foregrounds, classes_list, init_indexes = spread_cluster(
+        foregrounds,
+        classes_list,
+        init_indexes,
+        params,
+        limits,
+        dims,
+        background,
+        edge_policy,
+        max_occlusion,
+    )
+    curve_center = params[-1]
+    init_list = np.asarray(params)[init_indexes]
+    offsets = translate_offsets(init_list, limits, dims)
+
+    rois = []
     try:
-        final_background, modified_offs = compose(
-            foregrounds, background, init_list, curve_center, offsets
-        )
-        mask_new = getForegroundMask(
+        final_background, mask_new, mask_new_pil, rois = render_cluster(
             foregrounds,
             background,
             background_mask,
             classes_list,
-            modified_offs,
-            new_cluster,
+            init_list,
+            curve_center,
+            offsets,
+            edge_policy,
         )
-        mask_new_pil = Image.fromarray(mask_new)
         return final_background, mask_new, mask_new_pil, cache_for_update
 
     except ValueError:
@@ -286,15 +642,25 @@ def update_cluster(
 
     finally:
         history.pop()
-        history.append(cache_for_update)
+        record_history(cache_for_update, rois)
 
 
-def undo_func():
+def undo_func(image, mask):
+    """Restore the state before the last generate/add/update from the
+    current *image* and *mask*."""
 
     try:
-        old_cache = history.pop()
-        background, background_mask, *_ = old_cache
-        return background, background_mask, Image.fromarray(background_mask), old_cache
+        delta = history.pop()
+        background = np.array(image)
+        background_mask = np.array(mask)
+        delta.apply(background, background_mask)
+        old_cache = (background, background_mask, *delta.cluster)
+        return (
+            Image.fromarray(background),
+            background_mask,
+            Image.fromarray(background_mask),
+            old_cache,
+        )
 
     except IndexError:
         return None, None, None, None
@@ -303,14 +669,34 @@ def undo_func():
         traceback.print_exc()
 
 
-def save_generate(final_background, mask_new, mask_new_pil):
-    savedate = int(time.time() * 10)
-    final_background.save(f"./img_{savedate}.jpeg")
-    mask_new_pil.save(f"./label_{savedate}.png")
-    plt.imsave(
-        f"./rgb_label_{savedate}.png",
-        mask_new,
-        vmin=1,
-        vmax=5,
-        cmap=cmp,
-    )
+def encode_sample(final_background, mask_new, mask_new_pil):
+    """Encode a generated sample to its image, label and RGB label files,
+    keyed by file extension."""
+    with metrics.stage("encode"):
+        encoded = {}
+        for ext, image in (("jpeg", final_background), ("label.png", mask_new_pil)):
+            buffer = io.BytesIO()
+            image.save(buffer, format=ext.rsplit(".", 1)[-1])
+            encoded[ext] = buffer.getvalue()
+
+        # Palette PNG: class values stay as pixels, colored by the label palette
+        rgb_label = Image.fromarray(mask_new)
+        rgb_label.putpalette(get_label_palette().tobytes())
+        buffer = io.BytesIO()
+        rgb_label.save(buffer, format="png")
+        encoded["rgb_label.png"] = buffer.getvalue()
+    return encoded
+
+
+def save_generate(final_background, mask_new, mask_new_pil, path=".", savedate=None):
+    if savedate is None:
+        savedate = int(time.time() * 10)
+    encoded = encode_sample(final_background, mask_new, mask_new_pil)
+    for ext, name in (
+        ("jpeg", f"img_{savedate}.jpeg"),
+        ("label.png", f"label_{savedate}.png"),
+        ("rgb_label.png", f"rgb_label_{savedate}.png"),
+    ):
+        with metrics.stage("write"), open(os.path.join(path, name), "wb") as f:
+            f.write(encoded[ext])
+        metrics.count("bytes_written", len(encoded[ext]))
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+import zlib
+from collections import deque
+
+import numpy as np
+
+
+class Delta:
+    """Undo step holding only the patches of the image and label that an
+    operation painted over, along with the cluster it painted (classes,
+    foregrounds and curve indexes) so that it can be updated later."""
+
+    def __init__(self, image, mask, rois, cluster, compress=False):
+        self.rois = rois
+        self.cluster = cluster
+        self.compress = compress
+        self.patches = []
+        for roi in rois:
+            image_patch = np.ascontiguousarray(image[roi])
+            mask_patch = np.ascontiguousarray(mask[roi])
+            if compress:
+                self.patches.append(
+                    (
+                        (image_patch.shape, zlib.compress(image_patch, 1)),
+                        (mask_patch.shape, zlib.compress(mask_patch, 1)),
+                    )
+                )
+            else:
+                self.patches.append((image_patch, mask_patch))
+
+        self.nbytes = sum(fg.nbytes for fg in cluster[1])
+        for image_patch, mask_patch in self.patches:
+            for patch in (image_patch, mask_patch):
+                self.nbytes += len(patch[1]) if compress else patch.nbytes
+
+    def _decompress(self, patch):
+        shape, data = patch
+        return np.frombuffer(zlib.decompress(data), dtype=np.uint8).reshape(shape)
+
+    def apply(self, image, mask):
+        """Write the saved patches back into *image* and *mask* in place."""
+        for roi, (image_patch, mask_patch) in zip(self.rois, self.patches):
+            if self.compress:
+                image_patch = self._decompress(image_patch)
+                mask_patch = self._decompress(mask_patch)
+            image[roi] = image_patch
+            mask[roi] = mask_patch
+
+
+class History:
+    """Stack of undo deltas, bounded by the total size of the deltas.
+    The oldest steps are dropped once *max_bytes* is exceeded."""
+
+    def __init__(self, max_bytes=256 * 2 ** 20, compress=False):
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.nbytes = 0
+        self._steps = deque()
+
+    def __len__(self):
+        return len(self._steps)
+
+    def record(self, image, mask, rois, cluster):
+        """Save the *rois* of the *image* and *mask* about to be painted."""
+        delta = Delta(image, mask, rois, cluster, compress=self.compress)
+        self._steps.append(delta)
+        self.nbytes += delta.nbytes
+        while self.nbytes > self.max_bytes and len(self._steps) > 1:
+            self.nbytes -= self._steps.popleft().nbytes
+        return delta
+
+    def pop(self):
+        delta = self._steps.pop()
+        self.nbytes -= delta.nbytes
+        return delta
+
+    def clear(self):
+        self._steps.clear()
+        self.nbytes = 0
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+import argparse
+import contextlib
+import hashlib
+import io
+import logging
+import os
+import pathlib
+import sqlite3
+from collections import Counter
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+manifest_path = os.getcwd() + "/foregrounds.manifest"
+
+_schema = """
+CREATE TABLE IF NOT EXISTS foregrounds (
+    path TEXT PRIMARY KEY,
+    class INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    bbox_left INTEGER NOT NULL,
+    bbox_top INTEGER NOT NULL,
+    bbox_right INTEGER NOT NULL,
+    bbox_bottom INTEGER NOT NULL,
+    opaque INTEGER NOT NULL,
+    sha1 TEXT NOT NULL
+)
+"""
+
+
+def class_from_name(path):
+    """Class value of a foreground, from the digit before the last
+    underscore of its file name (3_blabla.png is class 3)."""
+    return int(path.rsplit("_", 1)[0][-1])
+
+
+def describe_foreground(data):
+    """Dimensions, tight bbox (left, top, right, bottom) of the non-empty
+    pixels, opaque pixel count and SHA-1 of the encoded foreground *data*."""
+    image = np.asarray(Image.open(io.BytesIO(data)).convert("RGBA"))
+    height, width = image.shape[:2]
+    rows = np.flatnonzero(image.max(axis=(1, 2)))
+    columns = np.flatnonzero(image.max(axis=(0, 2)))
+    if len(rows):
+        bbox = (columns[0], rows[0], columns[-1] + 1, rows[-1] + 1)
+    else:
+        bbox = (0, 0, 0, 0)
+    return {
+        "width": width,
+        "height": height,
+        "bbox_left": int(bbox[0]),
+        "bbox_top": int(bbox[1]),
+        "bbox_right": int(bbox[2]),
+        "bbox_bottom": int(bbox[3]),
+        "opaque": int(np.count_nonzero(image[:, :, 3])),
+        "sha1": hashlib.sha1(data).hexdigest(),
+    }
+
+
+class ForegroundManifest:
+    """Persistent SQLite index of the foreground library.
+
+    One row per foreground, keyed by its path relative to *fg_path*, with
+    its class, dimensions, tight bbox, opaque pixel count and content hash,
+    so that foregrounds can be listed, filtered and weighted without
+    opening them. refresh only decodes files whose mtime or size changed
+    since they were indexed. A connection is opened per call, so the
+    manifest can be shared with forked workers, which should open it
+    *read_only* so that only one process refreshes it."""
+
+    def __init__(
+        self,
+        path=manifest_path,
+        fg_path=os.getcwd() + "/foregrounds",
+        read_only=False,
+    ):
+        self.path = path
+        self.fg_path = fg_path
+        self.read_only = read_only
+        if not read_only:
+            with self._connect() as db:
+                db.execute(_schema)
+
+    @contextlib.contextmanager
+    def _connect(self):
+        if self.read_only:
+            uri = pathlib.Path(os.path.abspath(self.path)).as_uri() + "?mode=ro"
+            db = sqlite3.connect(uri, uri=True, timeout=30)
+        else:
+            db = sqlite3.connect(self.path, timeout=30)
+        db.row_factory = sqlite3.Row
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def refresh(self):
+        """Index new and changed foregrounds and drop deleted ones. Returns
+        the number of (added, updated, removed) foregrounds."""
+        with self._connect() as db:
+            known = {
+                row["path"]: (row["mtime_ns"], row["size"])
+                for row in db.execute("SELECT path, mtime_ns, size FROM foregrounds")
+            }
+            seen = set()
+            added = updated = 0
+            for sub_folder in sorted(os.listdir(self.fg_path)):
+                folder = os.path.join(self.fg_path, sub_folder)
+                for file in sorted(os.listdir(folder)):
+                    key = os.path.join(sub_folder, file)
+                    seen.add(key)
+                    stat = os.stat(os.path.join(folder, file))
+                    if known.get(key) == (stat.st_mtime_ns, stat.st_size):
+                        continue
+
+                    with open(os.path.join(folder, file), "rb") as f:
+                        record = describe_foreground(f.read())
+                    record.update(
+                        path=key,
+                        mtime_ns=stat.st_mtime_ns,
+                        size=stat.st_size,
+                    )
+                    record["class"] = class_from_name(key)
+                    db.execute(
+                        f"INSERT OR REPLACE INTO foregrounds ({', '.join(record)}) "
+                        f"VALUES ({', '.join('?' * len(record))})",
+                        tuple(record.values()),
+                    )
+                    if key in known:
+                        updated += 1
+                    else:
+                        added += 1
+
+            removed = known.keys() - seen
+            db.executemany(
+                "DELETE FROM foregrounds WHERE path = ?", [(key,) for key in removed]
+            )
+        if added or updated or removed:
+            logger.info(
+                f"Manifest: {added} added, {updated} updated, "
+                f"{len(removed)} removed foregrounds."
+            )
+        return added, updated, len(removed)
+
+    def records(self):
+        """Rows of every foreground as dicts, ordered by path."""
+        with self._connect() as db:
+            rows = db.execute("SELECT * FROM foregrounds ORDER BY path").fetchall()
+        return [dict(row) for row in rows]
+
+    def foreground_lists(self, min_opaque=0):
+        """Paths of the foregrounds of each class folder, in folder and file
+        name order, like a listing of *fg_path*, leaving out those with
+        fewer than *min_opaque* opaque pixels."""
+        lists = {}
+        for record in self.records():
+            sub_folder = record["path"].split(os.sep, 1)[0]
+            files = lists.setdefault(sub_folder, [])
+            if record["opaque"] >= min_opaque:
+                files.append(os.path.join(self.fg_path, record["path"]))
+        return [lists[sub_folder] for sub_folder in sorted(lists)]
+
+    def foreground_weights(self, field, min_opaque=0):
+        """Sampling probabilities of the foregrounds of each class folder,
+        in the order of foreground_lists, proportional to their *field*
+        (such as "opaque"). A class whose weights are all 0 is uniform."""
+        weights = {}
+        for record in self.records():
+            if field not in record:
+                raise ValueError(f"Unknown manifest field {field!r}")
+            sub_folder = record["path"].split(os.sep, 1)[0]
+            values = weights.setdefault(sub_folder, [])
+            if record["opaque"] >= min_opaque:
+                values.append(record[field])
+        probabilities = []
+        for sub_folder in sorted(weights):
+            values = np.asarray(weights[sub_folder], dtype=float)
+            if values.sum() > 0:
+                probabilities.append(values / values.sum())
+            else:
+                probabilities.append(np.full(len(values), 1 / max(len(values), 1)))
+        return probabilities
+
+    def sizes(self):
+        """(height, width) of the tight bbox of every foreground, keyed by
+        its full path."""
+        with self._connect() as db:
+            rows = db.execute(
+                "SELECT path, bbox_bottom - bbox_top, bbox_right - bbox_left "
+                "FROM foregrounds"
+            ).fetchall()
+        return {os.path.join(self.fg_path, row[0]): (row[1], row[2]) for row in rows}
+
+    def classes(self):
+        """Class of every foreground, keyed by its full path."""
+        with self._connect() as db:
+            rows = db.execute("SELECT path, class FROM foregrounds").fetchall()
+        return {os.path.join(self.fg_path, path): value for path, value in rows}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="tcg manifest",
+        description="Build or refresh the foreground manifest.",
+    )
+    parser.add_argument("--fg-path", default="./foregrounds", help="foregrounds")
+    parser.add_argument("--out", default=manifest_path, help="manifest file")
+    args = parser.parse_args(argv)
+
+    manifest = ForegroundManifest(args.out, os.path.abspath(args.fg_path))
+    manifest.refresh()
+    records = manifest.records()
+    counts = Counter(record["class"] for record in records)
+    for value, count in sorted(counts.items()):
+        logger.info(f"Class {value}: {count} foregrounds")
+    logger.info(f"{len(records)} foregrounds in {args.out}")
+    return 0
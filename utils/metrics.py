@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+import bisect
+import contextlib
+import json
+import os
+import threading
+import time
+
+# ? Histogram bucket upper bounds
+latency_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25)
+latency_buckets += (0.5, 1.0, 2.5, 5.0)
+count_buckets = (1, 2, 5, 10, 15, 20, 30, 50, 100, 200)
+
+_disabled = contextlib.nullcontext()
+
+
+class _Timer:
+    __slots__ = ("metrics", "name", "start")
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.start)
+
+
+class Metrics:
+    """Stage timers, counters and histograms for the generation pipeline.
+
+    Disabled by default, in which case stage, count and observe return
+    immediately. A snapshot is a plain dict, so metrics of worker processes
+    can be sent back and merged into the parent's."""
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.histograms = {}
+
+    def stage(self, name):
+        """Context manager timing a stage into the *name*_seconds histogram."""
+        if not self.enabled:
+            return _disabled
+        return _Timer(self, f"{name}_seconds")
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value, buckets=latency_buckets):
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = {
+                    "buckets": list(buckets),
+                    "counts": [0] * (len(buckets) + 1),
+                    "sum": 0.0,
+                    "count": 0,
+                }
+            histogram["counts"][bisect.bisect_left(histogram["buckets"], value)] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def snapshot(self, reset=False):
+        with self._lock:
+            snapshot = {
+                "counters": dict(self.counters),
+                "histograms": {
+                    name: dict(h, counts=list(h["counts"]))
+                    for name, h in self.histograms.items()
+                },
+            }
+            if reset:
+                self.counters = {}
+                self.histograms = {}
+        return snapshot
+
+    def merge(self, snapshot):
+        """Add the counts of another Metrics' snapshot to these."""
+        with self._lock:
+            for name, value in snapshot["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for name, other in snapshot["histograms"].items():
+                histogram = self.histograms.get(name)
+                if histogram is None:
+                    self.histograms[name] = dict(other, counts=list(other["counts"]))
+                    continue
+                for i, n in enumerate(other["counts"]):
+                    histogram["counts"][i] += n
+                histogram["sum"] += other["sum"]
+                histogram["count"] += other["count"]
+
+    def summary(self):
+        """Counters, and count, mean and approximate percentiles (bucket
+        upper bounds) of every histogram."""
+        snapshot = self.snapshot()
+        histograms = {}
+        for name, h in snapshot["histograms"].items():
+            stats = {"count": h["count"], "sum": h["sum"]}
+            stats["mean"] = h["sum"] / h["count"] if h["count"] else 0.0
+            for q in (0.5, 0.9, 0.99):
+                seen = 0
+                for bound, n in zip(h["buckets"] + [float("inf")], h["counts"]):
+                    seen += n
+                    if seen >= q * h["count"]:
+                        break
+                stats[f"p{int(q * 100)}"] = bound
+            histograms[name] = stats
+        return {"counters": snapshot["counters"], "histograms": histograms}
+
+    def write_json(self, path):
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def write_prometheus(self, path, prefix="tcg"):
+        """Write the metrics in the Prometheus text format, for the
+        node_exporter textfile collector. The file is replaced atomically."""
+        snapshot = self.snapshot()
+        lines = []
+        for name, value in sorted(snapshot["counters"].items()):
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            lines.append(f"{prefix}_{name}_total {value}")
+        for name, h in sorted(snapshot["histograms"].items()):
+            metric = f"{prefix}_{name}"
+            lines.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            for bound, n in zip(h["buckets"] + ["+Inf"], h["counts"]):
+                cumulative += n
+                lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+            lines.append(f"{metric}_sum {h['sum']}")
+            lines.append(f"{metric}_count {h['count']}")
+
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, path)
+
+
+metrics = Metrics()
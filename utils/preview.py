@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+from PIL import Image
+
+from .compositor import (composite, place_foregrounds, placement_in_bounds,
+                         plan_placement)
+from .gen_utils import translate_offsets
+from .spatial import limit_occlusion
+
+
+def reduce(image, level):
+    """*image* downscaled by 2 ** *level*, averaging blocks of pixels (the
+    *level*-th level of its image pyramid)."""
+    image = np.asarray(image)
+    if level == 0:
+        return image
+    return np.asarray(Image.fromarray(image).reduce(2 ** level))
+
+
+class ClusterPreview:
+    """Low resolution update_cluster, for live previews of a cluster while
+    its curve changes.
+
+    set_cluster takes the state cached by generate_cluster or update_cluster
+    and downscales its background, label and foregrounds once, by
+    2 ** *level*. render then places the cluster along a new curve like
+    update_cluster, with placement and bounds checked at full resolution,
+    but composites the small images. The undo history is left untouched."""
+
+    def __init__(self, level=1):
+        self.level = level
+        self.cache = None
+
+    def set_cluster(self, cache, thumbnail=None):
+        """Preview the cluster of *cache*. An already downscaled background,
+        such as the Curve View thumbnail, is used if it has the right size."""
+        background, background_mask, self.classes_list, foregrounds, _ = cache
+        factor = 2 ** self.level
+        self.cache = cache
+        self.init_indexes = cache[4]
+        self.dims = background.shape[:2]
+        self.shapes = [fg.shape[:2] for fg in foregrounds]
+
+        size = tuple(-(-n // factor) for n in self.dims)
+        if thumbnail is not None and thumbnail.shape[:2] == size:
+            self.background = thumbnail
+        else:
+            self.background = reduce(background, self.level)
+        self.background_mask = background_mask[::factor, ::factor]
+        self.foregrounds = [reduce(fg, self.level) for fg in foregrounds]
+
+    def render(
+        self,
+        params,
+        limits,
+        dims,
+        edge_policy="reject",
+        max_occlusion=None,
+        alpha_threshold=0,
+    ):
+        """Composite the cluster along the curve *params* (as for
+        update_cluster, with the same *edge_policy*, *max_occlusion* and
+        label *alpha_threshold*). Returns the downscaled (image, label);
+        raises ValueError if the cluster is out of bounds under
+        *edge_policy*."""
+        kept = range(len(self.shapes))
+        init_indexes = self.init_indexes
+        if max_occlusion is not None:
+            # Spread out with the full resolution foregrounds
+            indexes, placed = limit_occlusion(
+                self.cache[3],
+                params,
+                init_indexes,
+                limits,
+                dims,
+                max_occlusion,
+                bounds=None if edge_policy == "clip" else self.dims,
+                alpha_threshold=alpha_threshold,
+            )
+            if placed.any():
+                kept = np.flatnonzero(placed).tolist()
+                init_indexes = indexes
+        shapes = [self.shapes[i] for i in kept]
+        init_list = np.asarray(params)[[init_indexes[i] for i in kept]]
+        offsets = translate_offsets(init_list, limits, dims)
+        plan = plan_placement(shapes, init_list, params[-1], offsets)
+        placements = place_foregrounds(shapes, plan, self.dims, edge_policy)
+        inside = placement_in_bounds(shapes, plan, self.dims)
+
+        # Scale the offsets of the foregrounds left in, keeping rounded up
+        # sizes of those inside the image inside
+        factor = 2 ** self.level
+        dim_y, dim_x = self.background.shape[:2]
+        foregrounds, classes_list, small_plan = [], [], []
+        for i, (off_x, off_y) in enumerate(plan):
+            if placements[i] is None:
+                continue
+            fg = self.foregrounds[kept[i]]
+            off_x, off_y = off_x // factor, off_y // factor
+            if inside[i]:
+                off_x = min(off_x, dim_x - fg.shape[1])
+                off_y = min(off_y, dim_y - fg.shape[0])
+            foregrounds.append(fg)
+            classes_list.append(self.classes_list[kept[i]])
+            small_plan.append((off_x, off_y))
+        return composite(
+            foregrounds,
+            self.background,
+            self.background_mask,
+            classes_list,
+            small_plan,
+            alpha_threshold=alpha_threshold,
+            edge_policy="clip",
+        )
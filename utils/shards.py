@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+import glob
+import io
+import json
+import os
+import tarfile
+
+
+class ShardWriter:
+    """Write samples into size-bounded, WebDataset-style tar shards.
+
+    Every sample is stored as consecutive members *key.ext* (for example
+    ``7_00000042.jpeg``, ``7_00000042.label.png``). Each shard
+    ``shard-NNNNNN.tar`` has an ``shard-NNNNNN.idx`` index with one JSON
+    line per sample, giving the data offset and size of its members and the
+    end of the sample in the tar. A new shard is started once a shard reaches
+    *max_bytes*.
+
+    Opening a directory that already holds shards resumes the last one:
+    anything written after its last indexed sample (an interrupted write)
+    is truncated and new samples are appended. The keys already written are
+    available in *keys*."""
+
+    def __init__(self, path, max_bytes=1024 ** 3, prefix="shard"):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.prefix = prefix
+        self.keys = set()
+        self._file = None
+        self._tar = None
+        self._index = None
+
+        os.makedirs(path, exist_ok=True)
+        shards = sorted(glob.glob(os.path.join(path, f"{prefix}-*.tar")))
+        end = 0
+        for shard in shards:
+            end = 0
+            for record in self._read_index(shard):
+                self.keys.add(record["key"])
+                end = record["end"]
+
+        if shards and end < max_bytes:
+            self.shard = len(shards) - 1
+            self._open(end)
+        else:
+            self.shard = len(shards)
+
+    def _shard_path(self, shard, ext="tar"):
+        return os.path.join(self.path, f"{self.prefix}-{shard:06d}.{ext}")
+
+    def _read_index(self, shard):
+        index = shard[: -len("tar")] + "idx"
+        if not os.path.exists(index):
+            return []
+        with open(index) as f:
+            return [json.loads(line) for line in f if line.endswith("\n")]
+
+    def _open(self, end=0):
+        # Position after the last complete sample and write from there
+        tar_path = self._shard_path(self.shard)
+        self._file = open(tar_path, "r+b" if os.path.exists(tar_path) else "wb")
+        self._file.truncate(end)
+        self._file.seek(end)
+        self._tar = tarfile.open(fileobj=self._file, mode="w")
+        self._index = open(self._shard_path(self.shard, "idx"), "a")
+
+    def _close(self):
+        if self._tar is not None:
+            self._tar.close()
+            self._file.close()
+            self._index.close()
+            self._tar = None
+
+    def write(self, key, encoded):
+        """Append the sample *key* with members {ext: bytes} to the shard."""
+        if self._tar is None:
+            self._open()
+
+        members = {}
+        for ext, data in encoded.items():
+            info = tarfile.TarInfo(f"{key}.{ext}")
+            info.size = len(data)
+            self._tar.addfile(info, io.BytesIO(data))
+            # addfile stores a copy of info, so the data offset is worked
+            # back from the end of the padded data
+            blocks = -(-info.size // tarfile.BLOCKSIZE)
+            members[ext] = (self._tar.offset - blocks * tarfile.BLOCKSIZE, info.size)
+        self._file.flush()
+
+        record = {"key": key, "members": members, "end": self._tar.offset}
+        self._index.write(json.dumps(record) + "\n")
+        self._index.flush()
+        self.keys.add(key)
+
+        if self._tar.offset >= self.max_bytes:
+            self._close()
+            self.shard += 1
+
+    def close(self):
+        self._close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_shard(shard):
+    """Iterate over (key, {ext: bytes}) of the samples in the tar *shard*
+    through its index."""
+    index = shard[: -len("tar")] + "idx"
+    with open(shard, "rb") as f, open(index) as lines:
+        for line in lines:
+            if not line.endswith("\n"):
+                break
+            record = json.loads(line)
+            encoded = {}
+            for ext, (offset, size) in record["members"].items():
+                f.seek(offset)
+                encoded[ext] = f.read(size)
+            yield record["key"], encoded
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+from .compositor import placement_in_bounds, plan_placement
+from .gen_utils import translate_offsets
+
+# ? Curve points tried for a foreground before it is left out
+occlusion_tries = 8
+
+
+class _Placed:
+    __slots__ = ("top", "left", "mask", "covered", "opaque", "hidden")
+
+    def __init__(self, top, left, mask):
+        self.top = top
+        self.left = left
+        self.mask = mask
+        self.covered = np.zeros_like(mask)
+        self.opaque = np.count_nonzero(mask)
+        self.hidden = 0
+
+
+class OcclusionGrid:
+    """Uniform grid index of the foregrounds pasted so far, to bound how
+    much of each one the foregrounds pasted over it hide.
+
+    Every foreground is listed in the *cell* sized square cells its bounding
+    box covers, with its opaque mask and which of its opaque pixels are
+    already hidden. add only compares a new foreground with those sharing
+    one of its cells, so as long as occlusion is bounded, a placement costs
+    about the same however many foregrounds were placed before it."""
+
+    def __init__(self, cell=64):
+        self.cell = cell
+        self.cells = {}
+        self.items = []
+
+    def _cells(self, top, left, height, width):
+        c = self.cell
+        rows = range(top // c, (top + height - 1) // c + 1)
+        columns = range(left // c, (left + width - 1) // c + 1)
+        return [(row, column) for row in rows for column in columns]
+
+    def add(self, mask, top, left, max_ratio=1.0):
+        """Paste a foreground with the boolean opaque *mask* (image side up)
+        with its top left corner at (*top*, *left*), unless it would hide
+        more than *max_ratio* of the opaque pixels of a foreground pasted
+        before. Returns whether it was pasted."""
+        height, width = mask.shape
+        cells = self._cells(top, left, height, width)
+        neighbours = {i for cell in cells for i in self.cells.get(cell, ())}
+
+        updates = []
+        for i in sorted(neighbours):
+            item = self.items[i]
+            item_h, item_w = item.mask.shape
+            y0, y1 = max(top, item.top), min(top + height, item.top + item_h)
+            x0, x1 = max(left, item.left), min(left + width, item.left + item_w)
+            if y0 >= y1 or x0 >= x1:
+                continue
+
+            region = (
+                slice(y0 - item.top, y1 - item.top),
+                slice(x0 - item.left, x1 - item.left),
+            )
+            hidden = mask[y0 - top : y1 - top, x0 - left : x1 - left]
+            hidden = hidden & item.mask[region] & ~item.covered[region]
+            count = np.count_nonzero(hidden)
+            if not count:
+                continue
+            if item.hidden + count > max_ratio * item.opaque:
+                return False
+            updates.append((item, region, hidden, count))
+
+        for item, region, hidden, count in updates:
+            item.covered[region] |= hidden
+            item.hidden += count
+        for cell in cells:
+            self.cells.setdefault(cell, []).append(len(self.items))
+        self.items.append(_Placed(top, left, mask))
+        return True
+
+    def occlusion(self):
+        """Hidden fraction of the opaque pixels of every pasted foreground."""
+        return np.array(
+            [item.hidden / item.opaque if item.opaque else 0.0 for item in self.items]
+        )
+
+
+def limit_occlusion(
+    foregrounds,
+    params,
+    init_indexes,
+    limits,
+    dims,
+    max_ratio,
+    bounds=None,
+    tries=None,
+    alpha_threshold=0,
+):
+    """Place the cluster of *foregrounds* along the curve *params* (as
+    update_cluster does) so that none hides more than *max_ratio* of the
+    pixels above *alpha_threshold* of those pasted before it.
+
+    Each foreground tries its own curve point of *init_indexes* first, then
+    *tries* - 1 others evenly spread around the curve; with *bounds*, a
+    (dim_y, dim_x) image size, only points where it is inside the image.
+    Returns the curve point index of every foreground and a boolean array
+    of which ones could be placed; the others would be mostly hidden."""
+    if tries is None:
+        tries = occlusion_tries
+    points = np.asarray(params[:-1], dtype=float)
+    shapes = np.array([fg.shape[:2] for fg in foregrounds], dtype=int).reshape(-1, 2)
+    count = len(shapes)
+
+    # ? Candidate curve points of every foreground, planned all at once
+    steps = np.arange(tries) * len(points) // tries
+    candidates = (np.asarray(init_indexes, dtype=int)[:, None] + steps) % len(points)
+    candidate_shapes = np.repeat(shapes, tries, axis=0)
+    candidate_points = points[candidates.ravel()]
+    plan = plan_placement(
+        candidate_shapes,
+        candidate_points,
+        params[-1],
+        translate_offsets(candidate_points, limits, dims),
+    )
+    plan = np.array(plan, dtype=int).reshape(count, tries, 2)
+    if bounds is None:
+        fits = np.ones((count, tries), dtype=bool)
+        dim_y = 0
+    else:
+        fits = placement_in_bounds(candidate_shapes, plan.reshape(-1, 2), bounds)
+        fits = fits.reshape(count, tries)
+        dim_y = bounds[0]
+
+    grid = OcclusionGrid()
+    indexes = list(init_indexes)
+    placed = np.zeros(count, dtype=bool)
+    for i, foreground in enumerate(foregrounds):
+        mask = foreground[::-1, :, 3] > alpha_threshold
+        for j in np.flatnonzero(fits[i]).tolist():
+            off_x, off_y = plan[i, j].tolist()
+            if grid.add(mask, dim_y - off_y - mask.shape[0], off_x, max_ratio):
+                indexes[i] = int(candidates[i, j])
+                placed[i] = True
+                break
+    return indexes, placed
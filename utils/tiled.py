@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+import argparse
+import logging
+import os
+import struct
+import time
+import zlib
+
+import numpy as np
+from PIL import Image
+
+from .batch import sample_curve, sample_key
+from .compositor import (composite_tiled, edge_policies, place_foregrounds,
+                         plan_placement)
+from .gen_utils import sample_rng, translate_offsets
+from .generator import (cluster_edge_policy, get_foreground_list,
+                        get_label_palette, label_alpha_threshold,
+                        max_occlusion_ratio, sample_cluster)
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# ? Side of the blocks composited at once, and rows encoded at once
+tile_size = 1024
+png_rows = 256
+
+
+# ? Label modes whose first band holds the class values
+label_modes = ("L", "P", "LA", "1", "I", "I;16")
+
+
+def convert_raster(src, dst, label=False):
+    """Decode the background image *src*, or with *label* its label, into
+    the uncompressed .npy file *dst*, which generate_tiled memory-maps.
+    This is the only step that holds the whole image in memory, once per
+    background. Labels are kept single band; raises ValueError for a label
+    in a color mode, whose class values cannot be told apart."""
+    with Image.open(src) as image:
+        if label:
+            if image.mode not in label_modes:
+                raise ValueError(f"Label {src} is {image.mode}, not single band")
+            if image.mode not in ("L", "P"):
+                image = image.convert("L")
+        elif image.mode != "RGB":
+            image = image.convert("RGB")
+        np.save(dst, np.asarray(image))
+
+
+def _png_chunk(f, kind, data):
+    f.write(struct.pack(">I", len(data)) + kind + data)
+    f.write(struct.pack(">I", zlib.crc32(kind + data)))
+
+
+def write_png(path, array, palette=None, rows=None):
+    """Encode the uint8 *array* (grayscale, RGB, or class values colored by
+    the (256, 3) *palette*) as a PNG file, *rows* rows at a time, so that a
+    memory-mapped array is never read into memory whole."""
+    if rows is None:
+        rows = png_rows
+    height, width = array.shape[:2]
+    channels = 1 if array.ndim == 2 else array.shape[2]
+    color_type = 3 if palette is not None else {1: 0, 3: 2, 4: 6}[channels]
+    compressor = zlib.compressobj(6)
+
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        header = (width, height, 8, color_type, 0, 0, 0)
+        _png_chunk(f, b"IHDR", struct.pack(">IIBBBBB", *header))
+        if palette is not None:
+            _png_chunk(f, b"PLTE", np.asarray(palette, dtype=np.uint8).tobytes())
+
+        # Every row with the Up filter: its difference to the row above
+        previous = np.zeros((1, width * channels), dtype=np.uint8)
+        for top in range(0, height, rows):
+            strip = np.asarray(array[top : top + rows]).reshape(-1, width * channels)
+            filtered = np.empty((len(strip), width * channels + 1), dtype=np.uint8)
+            filtered[:, 0] = 2
+            np.subtract(strip, np.vstack((previous, strip[:-1])), out=filtered[:, 1:])
+            previous = strip[-1:]
+            data = compressor.compress(filtered.tobytes())
+            if data:
+                _png_chunk(f, b"IDAT", data)
+        _png_chunk(f, b"IDAT", compressor.flush())
+        _png_chunk(f, b"IEND", b"")
+    return os.path.getsize(path)
+
+
+def generate_tiled(
+    bg_path,
+    mask_path,
+    seed,
+    index,
+    out_dir=".",
+    climit=(5, 10),
+    limits=(-5, 15),
+    retries=10,
+    edge_policy=None,
+    max_occlusion=None,
+    tile=None,
+    npy=False,
+):
+    """Generate sample *index* of the dataset seeded by *seed* (as
+    generate_sample does) on the .npy background *bg_path* and label
+    *mask_path* (see convert_raster), with the curve spanning the whole
+    background.
+
+    Both are memory-mapped, and the image and label are composited into
+    memory-mapped .npy files in *out_dir* one *tile* block at a time, then
+    streamed into PNG files (or kept as .npy with *npy*), so memory use
+    depends on the tile size and not on the background size. Returns
+    whether the sample was written."""
+    if edge_policy is None:
+        edge_policy = cluster_edge_policy
+    if max_occlusion is None:
+        max_occlusion = max_occlusion_ratio
+    if tile is None:
+        tile = tile_size
+    rng = sample_rng(seed, index)
+    background = np.load(bg_path, mmap_mode="r")
+    background_mask = np.load(mask_path, mmap_mode="r")
+    dims = (background.shape[1], background.shape[0])
+
+    for attempt in range(retries + 1):
+        with metrics.stage("curve"):
+            params = sample_curve(limits, rng)
+        cluster = sample_cluster(
+            background,
+            params,
+            climit,
+            limits,
+            dims,
+            get_foreground_list(),
+            rng,
+            edge_policy,
+            max_occlusion,
+        )
+        if cluster is None:
+            continue
+        foregrounds, classes_list, init_indexes = cluster
+        shapes = [fg.shape[:2] for fg in foregrounds]
+        init_list = np.asarray(params)[init_indexes]
+        offsets = translate_offsets(init_list, limits, dims)
+        plan = plan_placement(shapes, init_list, params[-1], offsets)
+        try:
+            place_foregrounds(shapes, plan, background.shape[:2], edge_policy)
+        except ValueError:
+            metrics.count("out_of_bounds")
+            continue
+        break
+    else:
+        metrics.count("out_of_bounds_retries", retries)
+        metrics.count("images_failed")
+        return False
+    metrics.count("out_of_bounds_retries", attempt)
+
+    key = sample_key(seed, index)
+    image_path = os.path.join(out_dir, f"img_{key}.npy")
+    label_path = os.path.join(out_dir, f"label_{key}.npy")
+    image = np.lib.format.open_memmap(image_path, "w+", np.uint8, background.shape)
+    label = np.lib.format.open_memmap(
+        label_path, "w+", np.uint8, background_mask.shape
+    )
+    with metrics.stage("composite"):
+        composite_tiled(
+            foregrounds,
+            background,
+            background_mask,
+            classes_list,
+            plan,
+            (image, label),
+            tile,
+            label_alpha_threshold,
+            edge_policy,
+        )
+    image.flush()
+    label.flush()
+
+    if not npy:
+        with metrics.stage("encode"):
+            written = write_png(os.path.join(out_dir, f"img_{key}.png"), image)
+            written += write_png(os.path.join(out_dir, f"label_{key}.png"), label)
+            written += write_png(
+                os.path.join(out_dir, f"rgb_label_{key}.png"),
+                label,
+                palette=get_label_palette(),
+            )
+        metrics.count("bytes_written", written)
+        del image, label
+        os.remove(image_path)
+        os.remove(label_path)
+    metrics.count("images")
+    return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="tcg tiled",
+        description="Generate trash clusters on backgrounds too large for memory.",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    convert = commands.add_parser(
+        "convert", help="decode a background or label into a .npy raster"
+    )
+    convert.add_argument("src", help="image file")
+    convert.add_argument("dst", help=".npy file")
+    convert.add_argument("--label", action="store_true", help="src is a label")
+
+    generate = commands.add_parser("generate", help="generate images")
+    generate.add_argument("--background", required=True, help=".npy background")
+    generate.add_argument("--label", required=True, help=".npy background label")
+    generate.add_argument("--count", type=int, default=1, help="images to save")
+    generate.add_argument("--out", default=".", help="output directory")
+    generate.add_argument("--seed", type=int, default=None, help="base random seed")
+    generate.add_argument(
+        "--cluster-limit",
+        type=int,
+        nargs=2,
+        default=(5, 10),
+        metavar=("MIN", "MAX"),
+        help="range of foregrounds per cluster",
+    )
+    generate.add_argument(
+        "--retries", type=int, default=10, help="new curves tried when out of bounds"
+    )
+    generate.add_argument("--edge-policy", choices=edge_policies, default=None)
+    generate.add_argument("--max-occlusion", type=float, default=None)
+    generate.add_argument(
+        "--tile", type=int, default=tile_size, help="side of composited blocks"
+    )
+    generate.add_argument(
+        "--npy", action="store_true", help="keep .npy outputs instead of PNG"
+    )
+    args = parser.parse_args(argv)
+
+    # Orthomosaics are over PIL's decompression bomb limit
+    Image.MAX_IMAGE_PIXELS = None
+    if args.command == "convert":
+        try:
+            convert_raster(args.src, args.dst, args.label)
+        except ValueError as e:
+            logger.error(str(e))
+            return 1
+        return 0
+
+    os.makedirs(args.out, exist_ok=True)
+    seed = int(time.time()) if args.seed is None else args.seed
+    start = time.perf_counter()
+    done = 0
+    for index in range(args.count):
+        done += generate_tiled(
+            args.background,
+            args.label,
+            seed,
+            index,
+            args.out,
+            climit=args.cluster_limit,
+            retries=args.retries,
+            edge_policy=args.edge_policy,
+            max_occlusion=args.max_occlusion,
+            tile=args.tile,
+            npy=args.npy,
+        )
+    elapsed = time.perf_counter() - start
+    if done < args.count:
+        logger.warning(f"{args.count - done} images out of bounds.")
+    logger.info(f"Saved {done} images in {elapsed:.1f}s (seed {seed}).")
+    return 0 if done == args.count else 1
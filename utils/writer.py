@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+import concurrent.futures
+import logging
+import threading
+
+from .generator import save_generate
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncWriter:
+    """Run save_generate on a pool of background threads.
+
+    At most *max_pending* saves are queued or running; save blocks beyond
+    that, so a fast producer is slowed down to the speed of the encoders
+    instead of piling up images in memory. Image encoders release the GIL,
+    so encoding overlaps with the caller's work."""
+
+    def __init__(self, workers=2, max_pending=8):
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._futures = set()
+        self._lock = threading.Lock()
+
+    def _done(self, future):
+        self._slots.release()
+        with self._lock:
+            self._futures.discard(future)
+        if future.exception() is not None:
+            logger.error("Saving failed", exc_info=future.exception())
+
+    def save(self, *args, **kwargs):
+        """Queue save_generate(*args, **kwargs) and return its future."""
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(save_generate, *args, **kwargs)
+        except RuntimeError:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def flush(self):
+        """Wait for every queued save to finish."""
+        with self._lock:
+            futures = list(self._futures)
+        concurrent.futures.wait(futures)
+
+    def close(self):
+        self._executor.shutdown(wait=True)